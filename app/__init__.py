@@ -1,9 +1,12 @@
 """
 Microservice module
 This module contains the microservice code for
+    cache
+    catalog
     engine
     models
     server
+    similarity
     swagger
     views
 """
@@ -18,7 +21,10 @@ app.config.from_object('config.%s' % str(APP_SETTING))
 
 # Service needs app so must be placed after app is created
 import engine
+import cache
+import catalog
 import models
 import server
+import similarity
 import swagger
 import views
\ No newline at end of file
@@ -0,0 +1,516 @@
+"""
+Response Cache for Recommendation Reads
+
+Keeps recently served pages of GET /recommendations in process memory, so
+repeated identical queries do not reach the database.
+
+Entries
+-------
+key     - the normalized query (product id, type name, limit, cursor)
+tag     - (product id, type id) of the query, None when the query does not
+          filter on it, used to find the entries a write makes stale
+value   - whatever the server stores, the marshalled page and its next cursor
+
+Entries are evicted least recently used first once the cache holds maxsize
+of them, and expire ttl seconds after they were stored. A write of a product
+and type drops exactly the entries whose query could include that row.
+
+Shared Backend
+--------------
+When several instances of the service run, a cache attached to a backend
+becomes a near-cache in front of it: a local miss is looked up in the shared
+store, stored pages are written through to it, and an invalidation deletes
+the shared entries and is published on a channel that every other instance
+follows to evict its local copies.
+
+RedisBackend    - a Redis server, redis://host:port/db
+MemoryBackend   - in-process stand-in with the same behaviour, memory://
+
+Versions
+--------
+With a backend every invalidation also gives the tags it covers a new random
+version token in the shared store, etag() combines the tokens a query depends
+on into its entity tag. All instances, and the recompute job, write the same
+tokens, so a write anywhere changes the tag everywhere. A generation token
+changed by invalidate_type() and clear() retires every tag handed out before.
+The tokens expire after VERSION_TTL seconds and a missing one is replaced by a
+new random token, never by a value an earlier tag could hold. A cache without
+a backend only sees the writes of its own process, so it hands out no tags.
+"""
+import time
+import json
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'recommendations:'
+CHANNEL = KEY_PREFIX + 'invalidate'
+# seconds a version token lives without a write, its tags stop matching then
+VERSION_TTL = 24 * 60 * 60
+# seconds connect() waits before retrying an unreachable backend, doubled up to the maximum
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+
+class CacheBackend(object):
+    """ Shared store and message channel behind the near-caches of all instances """
+
+    def get(self, key):
+        """ Returns the string stored under a key, or None """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl, indexes=()):
+        """ Stores a string for ttl seconds and adds its key to the named indexes """
+        raise NotImplementedError
+
+    def delete_indexed(self, indexes):
+        """ Deletes the indexes and every key they hold, returns the number of keys deleted """
+        raise NotImplementedError
+
+    def get_versions(self, names):
+        """ Returns the version tokens stored under the names, None for the missing ones """
+        raise NotImplementedError
+
+    def set_versions(self, versions, ttl):
+        """ Stores a dict of version tokens by name for ttl seconds """
+        raise NotImplementedError
+
+    def publish(self, channel, message):
+        """ Sends a string to the subscribers of a channel """
+        raise NotImplementedError
+
+    def subscribe(self, channel, callback):
+        """ Calls callback(message) for every message published on a channel, returns an object with close() """
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Backend kept in process memory
+
+    Caches attached to the same MemoryBackend behave like instances sharing a
+    Redis server, except that messages are delivered before publish() returns.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._values = {}
+        self._indexes = {}
+        self._versions = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None or entry[0] <= self.clock():
+                self._values.pop(key, None)
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl, indexes=()):
+        with self._lock:
+            self._values[key] = (self.clock() + ttl, value)
+            for name in indexes:
+                self._indexes.setdefault(name, set()).add(key)
+
+    def delete_indexed(self, indexes):
+        with self._lock:
+            deleted = 0
+            for name in indexes:
+                for key in self._indexes.pop(name, ()):
+                    if self._values.pop(key, None) is not None:
+                        deleted += 1
+            return deleted
+
+    def get_versions(self, names):
+        with self._lock:
+            now = self.clock()
+            entries = [self._versions.get(name) for name in names]
+            return [entry[1] if entry is not None and entry[0] > now else None for entry in entries]
+
+    def set_versions(self, versions, ttl):
+        with self._lock:
+            expires = self.clock() + ttl
+            self._versions.update((name, (expires, token)) for name, token in versions.items())
+
+    def publish(self, channel, message):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+        return _MemorySubscription(self, channel, callback)
+
+
+class _MemorySubscription(object):
+    def __init__(self, backend, channel, callback):
+        self.backend = backend
+        self.channel = channel
+        self.callback = callback
+
+    def close(self):
+        with self.backend._lock:
+            callbacks = self.backend._subscribers.get(self.channel, [])
+            if self.callback in callbacks:
+                callbacks.remove(self.callback)
+
+
+class RedisBackend(CacheBackend):
+    """ Backend on a Redis server, needs the redis package """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl, indexes=()):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.setex(key, int(ttl), value)
+        for name in indexes:
+            # an index lives as long as its newest key, the older ones have expired by then
+            pipe.sadd(name, key)
+            pipe.expire(name, int(ttl))
+        pipe.execute()
+
+    def delete_indexed(self, indexes):
+        pipe = self.client.pipeline()
+        for name in indexes:
+            pipe.smembers(name)
+        pipe.delete(*indexes)
+        keys = set().union(*pipe.execute()[:-1])
+        return self.client.delete(*keys) if keys else 0
+
+    def get_versions(self, names):
+        return self.client.mget(names)
+
+    def set_versions(self, versions, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for name, token in versions.items():
+            pipe.setex(name, int(ttl), token)
+        pipe.execute()
+
+    def publish(self, channel, message):
+        self.client.publish(channel, message)
+
+    def subscribe(self, channel, callback):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: lambda message: callback(message['data'])})
+        # the worker thread's stop() closes the subscription
+        worker = pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+        worker.close = worker.stop
+        return worker
+
+
+def create_backend(url):
+    """ Returns the backend of a redis:// or memory:// URL """
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    if url.startswith('memory://'):
+        return MemoryBackend()
+    raise ValueError("Cache backend '{}' is not supported.".format(url))
+
+
+class ResponseCache(object):
+    """ Bounded LRU cache whose entries also expire after a time to live """
+
+    def __init__(self, maxsize=1024, ttl=30, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._version = 0
+        self._lock = threading.Lock()
+        self._reset_counts()
+        self.backend = None
+        self.backend_url = None
+        self._subscription = None
+        # (url, time of the next attempt, delay after it) while a backend is unreachable
+        self._retry = None
+        # tells the invalidations this cache published apart from the other instances'
+        self.instance_id = uuid.uuid4().hex
+
+    def _reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.shared_hits = 0
+        self.remote_invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, maxsize, ttl):
+        """ Changes the size and time to live, evicting entries if the cache shrank """
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._evict()
+
+    def attach(self, backend):
+        """
+        Shares the entries through a backend and follows the invalidations of the other instances
+
+        Returns False, and leaves the cache local, when the backend cannot be subscribed to.
+        """
+        self.detach()
+        try:
+            subscription = backend.subscribe(CHANNEL, self._on_message)
+        except Exception as error:
+            logger.warning('Cache backend subscribe failed: %s', error)
+            return False
+        self.backend = backend
+        self._subscription = subscription
+        return True
+
+    def detach(self):
+        """ Goes back to a cache local to this process """
+        if self._subscription is not None:
+            self._subscription.close()
+        self.backend = self.backend_url = self._subscription = self._retry = None
+
+    def connect(self, url):
+        """
+        Attaches the backend of a URL, or detaches when the URL is empty
+
+        While the backend is unreachable the cache stays local and the attempt
+        is repeated after RETRY_DELAY seconds, doubling up to RETRY_MAX_DELAY.
+        """
+        if url == self.backend_url:
+            return
+        if not url:
+            self.detach()
+            return
+        retry = self._retry if self._retry is not None and self._retry[0] == url else None
+        if retry is not None and self.clock() < retry[1]:
+            return
+        if not self.attach(create_backend(url)):
+            delay = retry[2] if retry is not None else RETRY_DELAY
+            self._retry = (url, self.clock() + delay, min(delay * 2, RETRY_MAX_DELAY))
+            return
+        self.backend_url = url
+
+    def get(self, key):
+        """ Returns the value stored for a key, or None when it is missing or expired """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] <= self.clock():
+                self._untag(key, entry[1])
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        if self.backend is None:
+            return None
+        data = self._remote('get', _shared_key(key))
+        if data is None:
+            return None
+        value, tag = json.loads(data)
+        with self._lock:
+            self.shared_hits += 1
+            self._store(key, value, tuple(tag))
+        return value
+
+    def version(self):
+        """
+        Returns a token for set()
+
+        Take it before reading from the database: if a write invalidates the
+        cache in the meantime, set() refuses the possibly stale value.
+        """
+        return self._version
+
+    def etag(self, product_id, rec_type_id):
+        """
+        Returns the entity tag of the Recommendations of a product and type
+
+        None for the product or type means any, like in a tag. The entity tag
+        changes with every invalidation of the query, read it before reading
+        the database. Returns None without a backend or while it is unreachable.
+        """
+        if self.backend is None:
+            return None
+        names = [_GENERATION, _version_key((product_id, rec_type_id))]
+        tokens = self._remote('get_versions', names)
+        if tokens is None:
+            return None
+        missing = dict((name, _token()) for name, token in zip(names, tokens) if token is None)
+        if missing:
+            # a new or flushed store, or expired tokens, the tags handed out before must not match
+            self._remote('set_versions', missing, VERSION_TTL)
+            tokens = [token or missing[name] for name, token in zip(names, tokens)]
+        return '.'.join(tokens)
+
+    def set(self, key, value, tag, version=None):
+        """ Stores a value under a key and tag, returns False if an invalidation made it stale """
+        with self._lock:
+            if version is not None and version != self._version:
+                return False
+            self._store(key, value, tag)
+        if self.backend is not None:
+            self._remote('set', _shared_key(key), json.dumps([value, tag]), self.ttl,
+                         [_tag_index(tag), _type_index(tag[1]), _ALL_INDEX])
+        return True
+
+    def invalidate(self, product_id, rec_type_id):
+        """ Drops the entries whose query can include a Recommendation of the product and type """
+        return self.invalidate_many([(product_id, rec_type_id)])
+
+    def invalidate_many(self, pairs):
+        """ Invalidates a list of (product id, type id) pairs at once, for writes of many rows """
+        tags = set()
+        for product_id, rec_type_id in pairs:
+            tags.update(_product_tags(product_id, rec_type_id))
+        if not tags:
+            return 0
+        with self._lock:
+            dropped = self._drop(tags)
+        self._bump([_version_key(tag) for tag in tags])
+        self._publish([_tag_index(tag) for tag in tags], {'op': 'invalidate', 'pairs': list(pairs)})
+        return dropped
+
+    def invalidate_type(self, rec_type_id):
+        """ Drops the entries whose query can include Recommendations of the type, for any product """
+        with self._lock:
+            dropped = self._drop_type(rec_type_id)
+        self._bump([_GENERATION])
+        self._publish([_type_index(rec_type_id), _type_index(None)],
+                      {'op': 'invalidate_type', 'rec_type_id': rec_type_id})
+        return dropped
+
+    def clear(self):
+        """ Removes every entry and resets the counters """
+        with self._lock:
+            self._clear_entries()
+            self._reset_counts()
+        self._bump([_GENERATION])
+        self._publish([_ALL_INDEX], {'op': 'clear'})
+
+    def info(self):
+        """ Returns the hit ratio, size and hit, miss, eviction, expiration and invalidation counts """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / float(lookups) if lookups else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'shared': self.backend is not None,
+                'shared_hits': self.shared_hits,
+                'remote_invalidations': self.remote_invalidations}
+
+    def _store(self, key, value, tag):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._untag(key, entry[1])
+        self._entries[key] = (self.clock() + self.ttl, tag, value)
+        self._tags.setdefault(tag, set()).add(key)
+        self._evict()
+
+    def _drop(self, tags):
+        self._version += 1
+        dropped = 0
+        for tag in tags:
+            for key in self._tags.pop(tag, ()):
+                del self._entries[key]
+                dropped += 1
+        self.invalidations += dropped
+        return dropped
+
+    def _drop_type(self, rec_type_id):
+        return self._drop([tag for tag in self._tags if tag[1] in (rec_type_id, None)])
+
+    def _clear_entries(self):
+        self._entries.clear()
+        self._tags.clear()
+        self._version += 1
+
+    def _bump(self, names):
+        """ Gives the names new version tokens in the shared store """
+        if self.backend is not None:
+            self._remote('set_versions', dict((name, _token()) for name in names), VERSION_TTL)
+
+    def _publish(self, indexes, message):
+        """ Deletes the shared entries in the indexes and tells the other instances to drop theirs """
+        if self.backend is None:
+            return
+        self._remote('delete_indexed', indexes)
+        message['origin'] = self.instance_id
+        self._remote('publish', CHANNEL, json.dumps(message))
+
+    def _on_message(self, data):
+        """ Applies an invalidation published by another instance to the local entries """
+        message = json.loads(data)
+        if message.get('origin') == self.instance_id:
+            return
+        with self._lock:
+            if message['op'] == 'invalidate':
+                self._drop(set(tag for pair in message['pairs'] for tag in _product_tags(*pair)))
+            elif message['op'] == 'invalidate_type':
+                self._drop_type(message['rec_type_id'])
+            elif message['op'] == 'clear':
+                self._clear_entries()
+            self.remote_invalidations += 1
+
+    def _remote(self, method, *args):
+        """ Calls the backend, while it is unreachable the cache works on its local entries """
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception as error:
+            logger.warning('Cache backend %s failed: %s', method, error)
+            return None
+
+    def _untag(self, key, tag):
+        keys = self._tags[tag]
+        keys.discard(key)
+        if not keys:
+            del self._tags[tag]
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            key, entry = self._entries.popitem(last=False)
+            self._untag(key, entry[1])
+            self.evictions += 1
+
+
+_ALL_INDEX = KEY_PREFIX + 'all'
+_GENERATION = KEY_PREFIX + 'generation'
+
+def _product_tags(product_id, rec_type_id):
+    """ Tags of the queries that can include a Recommendation of the product and type """
+    return [(product_id, rec_type_id), (product_id, None), (None, rec_type_id), (None, None)]
+
+def _shared_key(key):
+    return KEY_PREFIX + 'page:' + json.dumps(key)
+
+def _tag_index(tag):
+    return KEY_PREFIX + 'tag:%s:%s' % tuple(tag)
+
+def _type_index(rec_type_id):
+    return KEY_PREFIX + 'type:%s' % (rec_type_id,)
+
+def _version_key(tag):
+    return KEY_PREFIX + 'version:%s:%s' % tuple(tag)
+
+def _token():
+    return uuid.uuid4().hex[:12]
+
+# Shared by the request handlers of this process
+response_cache = ResponseCache()
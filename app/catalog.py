@@ -0,0 +1,150 @@
+"""
+Catalog Index for the Recommendation Engine
+
+Keeps the product catalog in memory so that up-sell candidates can be
+selected with bisect range lookups instead of scoring every product.
+
+Structures
+----------
+products      - product id -> ParsedProduct
+by_category   - category -> price sorted (price, product id) keys of that category
+global keys   - price sorted (price, product id) keys of the whole catalog
+
+The up-sell rule (SCORER_RULES['up-sell']) only gives weight to candidates in
+the same category or with a higher price, so the candidates of an anchor are
+its category plus the tail of the global price array above the anchor price.
+"""
+import bisect
+from engine import ParsedProduct, SCORER_RULES, metadata_cache
+
+
+class _PriceSortedKeys(object):
+    """ (price, product id) keys kept in price order, with the prices in a parallel list for bisect """
+
+    def __init__(self, keys=()):
+        self.keys = sorted(keys)
+        self.prices = [key[0] for key in self.keys]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, key):
+        index = bisect.bisect_left(self.keys, key)
+        self.keys.insert(index, key)
+        self.prices.insert(index, key[0])
+
+    def remove(self, key):
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            del self.keys[index]
+            del self.prices[index]
+
+    def above(self, price):
+        """ Returns the keys priced strictly higher than price """
+        return self.keys[bisect.bisect_right(self.prices, price):]
+
+    def between(self, low, high):
+        """ Returns the keys priced from low to high inclusive """
+        return self.keys[bisect.bisect_left(self.prices, low):bisect.bisect_right(self.prices, high)]
+
+
+class CatalogIndex(object):
+    """ In-memory index of the product catalog by category and by price """
+
+    def __init__(self, products=(), cache=None):
+        self.cache = cache if cache is not None else metadata_cache
+        self.products = {}
+        for product in products:
+            product = self.toProduct(product)
+            self.products[product.id] = product
+
+        grouped = {}
+        for product in self.products.itervalues():
+            grouped.setdefault(product.category, []).append((product.price, product.id))
+
+        self.by_category = dict((category, _PriceSortedKeys(keys))
+                                for category, keys in grouped.iteritems())
+        self._all = _PriceSortedKeys((product.price, product.id)
+                                     for product in self.products.itervalues())
+
+    def __len__(self):
+        return len(self.products)
+
+    def __contains__(self, product_id):
+        return product_id in self.products
+
+    def toProduct(self, product):
+        """ Accepts a ParsedProduct or a product JSON string """
+        if isinstance(product, ParsedProduct):
+            return product
+        return self.cache.get(product)
+
+    def get(self, product_id):
+        """ Returns the ParsedProduct with the given id or None """
+        return self.products.get(product_id)
+
+    def add(self, product):
+        """ Adds a product to the index, replacing any product with the same id """
+        product = self.toProduct(product)
+        self.remove(product.id)
+
+        key = (product.price, product.id)
+        self.products[product.id] = product
+        self.by_category.setdefault(product.category, _PriceSortedKeys()).insert(key)
+        self._all.insert(key)
+        return product
+
+    def remove(self, product_id):
+        """ Removes a product from the index, returns the removed ParsedProduct or None """
+        product = self.products.pop(product_id, None)
+        if product is None:
+            return None
+
+        key = (product.price, product.id)
+        self._all.remove(key)
+        category = self.by_category[product.category]
+        category.remove(key)
+        if not len(category):
+            del self.by_category[product.category]
+        return product
+
+    def productsInCategory(self, category):
+        """ Returns the ids of every product in a category, cheapest first """
+        keys = self.by_category.get(category)
+        return [key[1] for key in keys.keys] if keys else []
+
+    def productsPricedAbove(self, price, category=None):
+        """ Returns the ids of the products priced higher than price, optionally within one category """
+        keys = self._all if category is None else self.by_category.get(category)
+        return [key[1] for key in keys.above(price)] if keys else []
+
+    def productsPricedBetween(self, low, high, category=None):
+        """ Returns the ids of the products priced from low to high inclusive, optionally within one category """
+        keys = self._all if category is None else self.by_category.get(category)
+        return [key[1] for key in keys.between(low, high)] if keys else []
+
+    def getUpsellCandidates(self, anchor):
+        """
+        Returns (product id, weight) for every product the up-sell rule gives weight to
+
+        The anchor is a ParsedProduct or a product JSON string and is never
+        returned as its own candidate. Only the anchor's category and the
+        products priced above it are visited.
+        """
+        anchor = self.toProduct(anchor)
+        rule = SCORER_RULES['up-sell']
+        candidates = []
+
+        category = self.by_category.get(anchor.category)
+        if category:
+            higher = rule['same_category'] + rule['price_weight']
+            for price, product_id in category.keys:
+                if product_id != anchor.id:
+                    candidates.append((product_id, higher if price > anchor.price else rule['same_category']))
+
+        higher = rule['other_category'] + rule['price_weight']
+        for price, product_id in self._all.above(anchor.price):
+            if self.products[product_id].category != anchor.category:
+                candidates.append((product_id, higher))
+
+        return candidates
@@ -0,0 +1,139 @@
+"""
+Co-occurrence Ingestion for Accessory Recommendations
+
+Reads an order log line by line and learns which products are bought
+together, using memory that does not grow with the size of the log.
+
+Order log
+---------
+NDJSON, one order (basket) per line with the ids of the products bought:
+    {"order_id": 1001, "products": [23, 45, 51]}
+
+Structures
+----------
+CountMinSketch  - approximate count of every (product, other product) pair
+TopCandidates   - the products most often bought with one product, bounded to k entries
+basket counts   - exact number of baskets that contained each product
+
+Weights are normalized as the share of a product's baskets that also held the
+recommended product, so they fall between 0 and 1.
+"""
+import json
+import zlib
+import logging
+import numpy as np
+from models import Recommendation
+
+def readBaskets(path):
+    """ Yields the list of product ids of every order in an NDJSON order log """
+    with open(path) as log:
+        for number, line in enumerate(log, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                order = json.loads(line)
+                yield order.get('products', order.get('items')) or []
+            except (ValueError, AttributeError):
+                logging.warning("Skipping invalid order on line %d", number)
+
+def basketPairs(products, max_basket=50):
+    """ Yields every ordered pair of distinct products in a basket """
+    products = list(set(products))[:max_basket]
+    for product in products:
+        for other in products:
+            if product != other:
+                yield product, other
+
+
+class CountMinSketch(object):
+    """ Fixed size table of approximate counts, estimates never undercount """
+
+    def __init__(self, width=2 ** 20, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self._rows = np.arange(depth)
+
+    def _columns(self, key):
+        #double hashing gives depth independent-enough columns from two hashes
+        data = repr(key)
+        first = zlib.crc32(data) & 0xffffffff
+        second = (zlib.adler32(data) & 0xffffffff) | 1
+        return (first + self._rows * second) % self.width
+
+    def add(self, key, count=1):
+        """ Adds to the count of a key and returns its new estimate """
+        columns = self._columns(key)
+        self.table[self._rows, columns] += count
+        return int(self.table[self._rows, columns].min())
+
+    def estimate(self, key):
+        """ Returns the estimated count of a key """
+        return int(self.table[self._rows, self._columns(key)].min())
+
+
+class TopCandidates(object):
+    """ The k keys with the highest counts seen so far """
+    __slots__ = ('k', 'counts')
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+
+    def offer(self, key, count):
+        """ Records the latest count of a key, evicting the lowest count when full """
+        counts = self.counts
+        if key in counts or len(counts) < self.k:
+            counts[key] = count
+            return
+        lowest = min(counts, key=counts.get)
+        if count > counts[lowest]:
+            del counts[lowest]
+            counts[key] = count
+
+
+class CooccurrenceIngester(object):
+    """ Streams baskets into a count-min sketch and per product top candidates """
+
+    def __init__(self, width=2 ** 20, depth=4, top=20, max_basket=50):
+        self.sketch = CountMinSketch(width, depth)
+        self.top = top
+        self.max_basket = max_basket
+        self.baskets = 0
+        self.basket_counts = {}
+        self.candidates = {}
+
+    def add(self, products):
+        """ Counts one basket """
+        self.baskets += 1
+        for product in set(products):
+            self.basket_counts[product] = self.basket_counts.get(product, 0) + 1
+        for product, other in basketPairs(products, self.max_basket):
+            count = self.sketch.add((product, other))
+            top = self.candidates.get(product)
+            if top is None:
+                top = self.candidates[product] = TopCandidates(self.top)
+            top.offer(other, count)
+
+    def ingest(self, baskets):
+        """ Counts every basket of an iterable, such as readBaskets(path) """
+        for products in baskets:
+            self.add(products)
+        return self
+
+    def recommendations(self, rec_type_id, min_count=2):
+        """
+        Yields a Recommendation for every product pair bought together at least min_count times
+
+        The weight is the estimated pair count over the product's basket count,
+        capped at 1. The rows are not added to the session.
+        """
+        for product, top in self.candidates.iteritems():
+            total = float(self.basket_counts[product])
+            ranked = sorted(((self.sketch.estimate((product, other)), other) for other in top.counts),
+                            key=lambda item: (-item[0], item[1]))
+            for count, other in ranked:
+                if count >= min_count:
+                    yield Recommendation(product_id=int(product), rec_type_id=rec_type_id,
+                                         rec_product_id=int(other), weight=min(count / total, 1.0))
@@ -1,57 +1,324 @@
 import json
+import hashlib
+import heapq
+import operator
+import threading
+import numpy as np
+from collections import OrderedDict
+
+INVALID_METADATA = "Invalid metadata! Confirm you entered an id, category, and price. Also, confirm that price is a numeric value!"
+
+class ParsedProduct(object):
+	""" Product metadata decoded once, with the price already converted to a float """
+	__slots__ = ('id', 'category', 'price')
+
+	def __init__(self, id, category, price):
+		self.id = id
+		self.category = category
+		self.price = price
+
+	def __repr__(self):
+		return '{ "id": %r, "category": %r, "price": %r }' % (self.id, self.category, self.price)
+
+	@classmethod
+	def fromMetaData(cls, metadata):
+		""" Decodes a product JSON string, raises if the id, category or price is missing or invalid """
+		product = json.loads(metadata)
+		return cls(product['id'], product['category'], float(product['price']))
+
+
+class MetaDataCache(object):
+	""" Bounded LRU cache of ParsedProduct records keyed by a hash of the metadata content """
+
+	def __init__(self, maxsize=4096):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._records = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, metadata):
+		""" Returns the ParsedProduct for a metadata string, decoding it only on a cache miss """
+		if not isinstance(metadata, bytes):
+			metadata = metadata.encode('utf-8')
+		key = hashlib.sha1(metadata).digest()
+
+		with self._lock:
+			record = self._records.pop(key, None)
+			if record is not None:
+				self._records[key] = record
+				self.hits += 1
+				return record
+			self.misses += 1
+
+		record = ParsedProduct.fromMetaData(metadata)
+
+		with self._lock:
+			self._records[key] = record
+			if len(self._records) > self.maxsize:
+				self._records.popitem(last=False)
+		return record
+
+	def clear(self):
+		""" Removes every record and resets the hit and miss counts """
+		with self._lock:
+			self._records.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def info(self):
+		""" Returns the hit and miss counts along with the current and maximum size """
+		return {'hits': self.hits,
+				'misses': self.misses,
+				'size': len(self._records),
+				'maxsize': self.maxsize}
+
+class _RankedCandidate(object):
+	""" Heap entry for top-K selection, the smallest entry is the worst candidate kept """
+	__slots__ = ('weight', 'id')
+
+	def __init__(self, weight, id):
+		self.weight = weight
+		self.id = id
+
+	#lower weights rank lower, equal weights are broken by the higher product id ranking lower
+	def __lt__(self, other):
+		if self.weight != other.weight:
+			return self.weight < other.weight
+		return self.id > other.id
+
+
+#shared by every Engine unless one is given its own cache
+metadata_cache = MetaDataCache()
+
+# Rules for each recommendation type, by RecommendationType name
+#   same_category  - weight added when both products share a category
+#   other_category - weight added when the categories differ
+#   price          - 'higher' or 'lower', how the candidate price must compare to the anchor price
+#   price_weight   - weight added when the price comparison holds
+# Only up-sell is scored by rules, the original same category / higher price
+# weights. Accessory and cross-sell are not rule based (see cooccurrence and
+# similarity), types without rules get "Invalid rec_type_id" from the Engine.
+SCORER_RULES = {
+	'up-sell': {'same_category': 1, 'other_category': 0, 'price': 'higher', 'price_weight': 1}
+}
+
+#the seeded recommendation types, used until the registry is loaded from the database
+DEFAULT_REC_TYPES = ((1, 'up-sell'), (2, 'accessory'), (3, 'cross-sell'))
+
+def _compilePriceTest(rule):
+	""" Returns a test of (candidate price, anchor price) that works on floats and numpy arrays """
+	if rule['price'] == 'higher':
+		return operator.gt
+	if rule['price'] == 'lower':
+		return operator.lt
+	raise ValueError("Unknown price comparison '%s'" % rule['price'])
+
+
+def _categoryMatches(categories, category, count):
+	""" Returns which of count candidates share the anchor category, none when the two cannot be compared """
+	if categories.dtype.kind in 'biuf' and not isinstance(category, (int, long, float, np.number)):
+		return np.zeros(count, dtype=bool)
+	if categories.dtype.kind in 'SU' and not isinstance(category, basestring):
+		return np.zeros(count, dtype=bool)
+	matches = categories == category
+	if np.shape(matches) != (count,):
+		return np.zeros(count, dtype=bool)
+	return matches
+
+
+class Scorer(object):
+	""" The per-pair and batch scoring functions of one recommendation type """
+	__slots__ = ('name', 'score', 'scoreBatch')
+
+	def __init__(self, name, rule):
+		self.name = name
+
+		#resolve everything the scoring functions need once, up front
+		same_weight = rule['same_category']
+		other_weight = rule['other_category']
+		price_weight = rule['price_weight']
+		price_test = _compilePriceTest(rule)
+		get_category = operator.attrgetter('category')
+		get_price = operator.attrgetter('price')
+
+		def score(product_1, product_2):
+			""" Returns the weight of one parsed candidate against the parsed anchor """
+			if get_category(product_1) == get_category(product_2):
+				weight = same_weight
+			else:
+				weight = other_weight
+			if price_test(get_price(product_2), get_price(product_1)):
+				weight += price_weight
+			return weight
+
+		def scoreBatch(product_1, categories, prices, category=None):
+			""" Returns the weights of candidate columns against the parsed anchor """
+			if category is None:
+				category = get_category(product_1)
+			matches = _categoryMatches(np.asarray(categories), category, len(prices))
+			weights = np.where(matches, same_weight, other_weight).astype(np.int64)
+			weights += price_weight * price_test(prices, get_price(product_1))
+			return weights
+
+		self.score = score
+		self.scoreBatch = scoreBatch
+
+	def __repr__(self):
+		return '<Scorer %s>' % self.name
+
+
+class ScorerRegistry(object):
+	""" Maps recommendation type ids to their compiled Scorer """
+
+	def __init__(self, rec_types=DEFAULT_REC_TYPES):
+		self._scorers = {}
+		self.load(rec_types)
+
+	def load(self, rec_types):
+		"""
+		Compiles a Scorer for every recommendation type that has rules
+
+		rec_types - RecommendationType records, or (id, name) pairs
+		"""
+		scorers = {}
+		for rec_type in rec_types:
+			if isinstance(rec_type, tuple):
+				type_id, name = rec_type
+			else:
+				type_id, name = rec_type.id, rec_type.name
+			if name in SCORER_RULES:
+				scorers[type_id] = Scorer(name, SCORER_RULES[name])
+		self._scorers = scorers
+
+	def get(self, rec_type_id):
+		""" Returns the Scorer for a recommendation type id, or None """
+		return self._scorers.get(rec_type_id)
+
+	def __contains__(self, rec_type_id):
+		return rec_type_id in self._scorers
+
+#shared by every Engine unless one is given its own registry
+scorer_registry = ScorerRegistry()
 
 class Engine:
 
-	def __init__(self,product_1_metadata, rec_type_id):
+	def __init__(self,product_1_metadata, rec_type_id, cache=None, registry=None):
 		self.product_1_metadata = product_1_metadata
 		self.rec_type_id = rec_type_id
+		self.cache = cache if cache is not None else metadata_cache
+		self.scorer = (registry if registry is not None else scorer_registry).get(rec_type_id)
+		self._product_1 = None
+
+	#the anchor product is looked up once and then reused for every candidate
+	def _getAnchor(self):
+		if self._product_1 is None:
+			self._product_1 = self.cache.get(self.product_1_metadata)
+		return self._product_1
+
+	#weight is the relation of another product to this product
+	def getWeight (self, product_2_metadata):
+		if (self.product_1_metadata == "" or product_2_metadata == ""):
+			return "Missing metadata for one or both products!"
 
-	#assumes that we recieve JSON Data in this Manner	
-	def parseMetaData(self, product_2_metadata):
 		try:
-			if (self.product_1_metadata!= "" and product_2_metadata!= ""):
-				product_1 = json.loads(self.product_1_metadata)
-				product_2 = json.loads(product_2_metadata)
-				return product_1, product_2
-			return ("Missing metadata for one or both products!")
+			product_1 = self._getAnchor()
+			product_2 = self.cache.get(product_2_metadata)
+		except:
+			return INVALID_METADATA
+
+		if (self.scorer is None):
+			return "Invalid rec_type_id"
+
+		return self.scorer.score(product_1, product_2)
 
-		#down the road, we will need to test specific type errors
-		except Exception as exception:
-			return (str(type(exception)))
+	#returns the best k candidates, best first, as (product id, weight) tuples
+	def getTopCandidates(self, candidates_metadata, k):
+		"""
+		Streams candidates through a heap bounded to k entries so memory stays O(k)
 
-	def _getUpsellWeight(self, product_1, product_2):
+		candidates_metadata - any iterable of product JSON strings, it is consumed once
+		k                   - the number of candidates to return
+
+		Candidates with equal weights are ordered by product id. Candidates
+		with missing or invalid metadata are skipped.
+		"""
+		if (self.scorer is None):
+			return "Invalid rec_type_id"
+		if k <= 0:
+			return []
+
+		try:
+			product_1 = self._getAnchor()
+		except:
+			return INVALID_METADATA
+
+		score = self.scorer.score
+		heap = []
+		for metadata in candidates_metadata:
 			try:
-				prod_1_id = product_1['id']
-				prod_1_category = product_1['category']
-				prod_1_price = float(product_1['price'])
-				
-				prod_2_id = product_2['id']
-				prod_2_category = product_2['category']
-				prod_2_price = float(product_2['price'])
+				product_2 = self.cache.get(metadata)
 			except:
-				return "Invalid metadata! Confirm you entered an id, category, and price. Also, confirm that price is a numeric value!"
-
-			weight = 0
-			if prod_1_category == prod_2_category:
-				weight +=1
-			if prod_2_price > prod_1_price:
-				weight +=1
-			
-			#... other conditions
-			
-			return weight
+				continue
 
+			weight = score(product_1, product_2)
+			if len(heap) < k:
+				heapq.heappush(heap, _RankedCandidate(weight, product_2.id))
+				continue
+
+			worst = heap[0]
+			if weight > worst.weight or (weight == worst.weight and product_2.id < worst.id):
+				heapq.heapreplace(heap, _RankedCandidate(weight, product_2.id))
+
+		heap.sort(reverse=True)
+		return [(candidate.id, candidate.weight) for candidate in heap]
+
+	#scores a whole candidate set in one pass, candidates are given as columns
+	#(one entry per candidate) instead of one JSON string per candidate
+	def scoreCandidates(self, categories, prices, category_codes=None):
+		"""
+		Returns a numpy array with the weight of every candidate
+
+		categories     - array of candidate categories (or category codes)
+		prices         - array of candidate prices
+		category_codes - dict mapping category names to the codes used in categories
+		"""
+		if (self.scorer is None):
+			return "Invalid rec_type_id"
+
+		try:
+			product_1 = self._getAnchor()
+			prices = np.asarray(prices, dtype=np.float64)
+		except:
+			return INVALID_METADATA
+
+		category = None
+		if category_codes is not None:
+			category = category_codes.get(product_1.category, -1)
+
+		return self.scorer.scoreBatch(product_1, np.asarray(categories), prices, category)
 
-	#weight is the relation of another product to this product
-	def getWeight (self, product_2_metadata):
-		product_1, product_2 = self.parseMetaData(product_2_metadata)
 
-		if (self.rec_type_id == 1):
-			return self._getUpsellWeight(product_1, product_2)
+def buildCandidateColumns(products_metadata, category_codes=None, cache=None):
+	"""
+	Converts a list of product JSON strings into the columns used by Engine.scoreCandidates
 
-		return "Invalid rec_type_id"
+	Returns the product ids, the category codes, the prices and the category_codes
+	dict (new categories are added to the one passed in)
+	"""
+	if category_codes is None:
+		category_codes = {}
+	if cache is None:
+		cache = metadata_cache
 
-		#... more comparisons to come
+	count = len(products_metadata)
+	ids = []
+	categories = np.empty(count, dtype=np.int64)
+	prices = np.empty(count, dtype=np.float64)
+	for i, metadata in enumerate(products_metadata):
+		product = cache.get(metadata)
+		ids.append(product.id)
+		categories[i] = category_codes.setdefault(product.category, len(category_codes))
+		prices[i] = product.price
 
-	
-	
\ No newline at end of file
+	return ids, categories, prices, category_codes
@@ -37,16 +37,38 @@ import os
 import json
 import urlparse
 import logging
+import itertools
 from datetime import datetime
+from contextlib import contextmanager
+from functools import wraps
 from cerberus import Validator
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy import Column, ForeignKey, Integer, String, Float, Boolean, DateTime
-from sqlalchemy import Index, UniqueConstraint
-from sqlalchemy.orm import relationship, backref, sessionmaker
-from flask_sqlalchemy import Model, SQLAlchemy
+from sqlalchemy import Index, UniqueConstraint, and_, or_, func, bindparam, inspect, select
+from sqlalchemy.schema import AddConstraint
+from sqlalchemy.orm import relationship, backref, sessionmaker, contains_eager
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.sql.expression import UpdateBase
+from flask_sqlalchemy import Model, SQLAlchemy, SignallingSession
 from psycopg2 import OperationalError
 from . import app
 
+# replica_read finders running on this thread
+_routing = threading.local()
+
+def replica_read(function):
+    """ Lets the queries of a finder go to a read replica, when any are configured """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_routing, 'depth', 0)
+        _routing.depth = depth + 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _routing.depth = depth
+    return wrapper
+
 """ Base DB Model """
 class BaseModel(Model):
     __abstract__ = True
@@ -60,27 +82,24 @@ class BaseModel(Model):
     updated = Column(DateTime, onupdate=datetime.utcnow, default=datetime.utcnow)
 
     def save(self):
-        try:
-            if not self.id:
-                db.session.add(self)
-
-            db.session.commit()
-        except:
-            db.session.rollback()
+        """ Adds the record to the session and commits it, unless inside a transaction() """
+        if not self.id:
+            db.session.add(self)
+        _commit()
 
     def delete(self):
-        try:
-            db.session.delete(self)
-            db.session.commit()
-        except:
-            db.session.rollback()
+        """ Deletes the record and commits it, unless inside a transaction() """
+        db.session.delete(self)
+        _commit()
 
     @classmethod
+    @replica_read
     def all(cls):
         """ Returns all records from the database """
         return cls.query.all()
 
     @classmethod
+    @replica_read
     def count(cls):
         """ Return the total number of records in table """
         return cls.query.count()
@@ -91,16 +110,95 @@ class BaseModel(Model):
         cls.query.delete()
 
     @classmethod
+    @replica_read
     def find_by_id(cls, id):
         """ Find a Record by primary key """
         return cls.query.get(id)
 
-db = SQLAlchemy(model_class=BaseModel, app=app)
+class RoutingSession(SignallingSession):
+    """
+    Session that sends the queries of replica_read finders to the read replicas
+
+    The replicas are the SQLALCHEMY_BINDS keys listed in SQLALCHEMY_REPLICAS and
+    are used round-robin, everything else goes to the primary. Once a session
+    has written, or use_primary() was called, all of its queries go to the
+    primary so that it reads its own writes.
+    """
+    _next_replica = itertools.count()
+
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.db = db
+        self.primary_only = False
+
+    def use_primary(self):
+        """ Sends every later query of this session to the primary """
+        self.primary_only = True
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.primary_only = True
+        elif not self.primary_only and getattr(_routing, 'depth', 0):
+            replicas = self.app.config.get('SQLALCHEMY_REPLICAS')
+            if replicas:
+                replica = replicas[next(self._next_replica) % len(replicas)]
+                return self.db.get_engine(self.app, bind=replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with RoutingSession sessions """
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy(model_class=BaseModel, app=app)
+
+# depth of the transaction() blocks open on this thread
+_unit_of_work = threading.local()
+
+@contextmanager
+def transaction():
+    """
+    Unit of work: every save() and delete() inside the block is committed together
+
+    Nothing is committed until the outermost block exits, nested blocks join
+    it. An error anywhere in the block rolls the whole unit back and is raised
+    again.
+    """
+    depth = getattr(_unit_of_work, 'depth', 0)
+    _unit_of_work.depth = depth + 1
+    try:
+        yield db.session
+        if not depth:
+            db.session.commit()
+    except:
+        if not depth:
+            db.session.rollback()
+        raise
+    finally:
+        _unit_of_work.depth = depth
+
+def _commit():
+    """ Commits the session unless a transaction() is open, rolling back on error """
+    if getattr(_unit_of_work, 'depth', 0):
+        return
+    try:
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when de-serializing """
     pass
 
+# range of the Integer columns, larger ids are refused by the database
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+# errors reported for the rows of a bulk insert that the database refused
+ROW_CONFLICT = 'Recommendation conflicts with an existing one'
+ROW_INVALID = 'Recommendation could not be stored'
+
 class RecommendationType(db.Model):
     """ Lookup table to store the Recommendation Types """
     # PK | Name      | Is Active | Product Query
@@ -129,6 +227,7 @@ class RecommendationType(db.Model):
                 'is_active': self.is_active}
 
     @classmethod
+    @replica_read
     def find_by_name(cls, rec_name):
         """ Find a Recommendation Type By Name """
         return (cls.query.filter_by(name=str(rec_name.lower()))
@@ -148,22 +247,40 @@ class Recommendation(db.Model):
     # 3  | 33         | 1       | 45                    | .6
 
     schema = {
-        'id': {'type': 'integer'},
-        'product_id': {'type': 'integer', 'required': True},
-        'rec_type_id': {'type': 'integer', 'required': True},
-        'rec_product_id': {'type': 'integer', 'required': True},
+        'id': {'type': 'integer', 'min': INT_MIN, 'max': INT_MAX},
+        'product_id': {'type': 'integer', 'required': True, 'min': INT_MIN, 'max': INT_MAX},
+        'rec_type_id': {'type': 'integer', 'required': True, 'min': INT_MIN, 'max': INT_MAX},
+        'rec_product_id': {'type': 'integer', 'required': True, 'min': INT_MIN, 'max': INT_MAX},
         'weight': {'type': 'float', 'required': True}
         }
     __validator = Validator(schema)
 
+    set_schema = {
+        'rec_product_id': {'type': 'integer', 'required': True, 'min': INT_MIN, 'max': INT_MAX},
+        'weight': {'type': 'float', 'required': True}
+        }
+    __set_validator = Validator(set_schema)
+
+    lookup_schema = {
+        'product_ids': {'type': 'list', 'required': True, 'empty': False,
+                        'schema': {'type': 'integer', 'min': INT_MIN, 'max': INT_MAX}},
+        'type': {'type': 'string', 'nullable': True},
+        'limit': {'type': 'integer', 'min': 1, 'nullable': True}
+        }
+    __lookup_validator = Validator(lookup_schema)
+
     __tablename__ = 'recommendation'
+    __table_args__ = (UniqueConstraint('product_id', 'rec_type_id', 'rec_product_id',
+                                       name='uq_recommendation_product_type_rec_product'),)
     id = Column(Integer, primary_key = True)
     product_id = Column(Integer, unique=False)
     rec_type_id = Column(Integer, ForeignKey('recommendation_type.id'), nullable=False)
     rec_product_id = Column(Integer, nullable=False)
     weight = Column(Float, nullable=False)
 
-    rec_type = relationship('RecommendationType')
+    # loaded in the same query as the Recommendation so that serialize()
+    # never issues one extra SELECT per row
+    rec_type = relationship('RecommendationType', lazy='joined', innerjoin=True)
 
     def __repr__(self):
         return '{ "id": %s, "product_id": %s, "rec_type_id": %s, "rec_product_id": %s, "weight": %s}' % (self.id, self.product_id, self.rec_type_id, self.rec_product_id, self.weight)
@@ -194,24 +311,310 @@ class Recommendation(db.Model):
         return self
 
     @classmethod
-    def find_by_product_id(cls, prod_id):
-        """ Find all Recommendations by Product Id """
-        return (cls.query.filter_by(product_id=int(prod_id))
-                .filter(cls.rec_type.has(RecommendationType.is_active == True))).all()
+    def validate_many(cls, items):
+        """
+        Validates many Recommendations in a single pass
+
+        Args:
+            items (list): dictionaries of Recommendation data, anything else is invalid
+        Returns:
+            the valid rows as (index, row) tuples and the errors as
+            {'index': index, 'errors': ...} dictionaries
+        """
+        type_ids = set(type_id for (type_id,) in db.session.query(RecommendationType.id))
+        rows = []
+        errors = []
+        for index, data in enumerate(items):
+            if not isinstance(data, dict):
+                errors.append({'index': index, 'errors': 'Recommendation data must be a JSON object'})
+            elif not cls.__validator.validate(data):
+                errors.append({'index': index, 'errors': cls.__validator.errors})
+            elif data['rec_type_id'] not in type_ids:
+                errors.append({'index': index, 'errors': {'rec_type_id': ['unknown recommendation type']}})
+            else:
+                rows.append((index, {'product_id': data['product_id'],
+                                     'rec_type_id': data['rec_type_id'],
+                                     'rec_product_id': data['rec_product_id'],
+                                     'weight': float(data['weight'])}))
+        return rows, errors
 
     @classmethod
-    def find_by_type(cls, rec_type):
-        """ Find all Recommendations by Recommenation Type """
-        return (cls.query.filter_by(rec_type_id = rec_type.id)
-                .filter(cls.rec_type.has(RecommendationType.is_active == True))).all()
+    def bulk_insert(cls, rows, atomic=False, batch_size=1000):
+        """
+        Inserts validated rows with one multi-row INSERT per batch, without committing
+
+        Args:
+            rows (list): (index, row) tuples from validate_many
+            atomic (bool): let a database error propagate instead of skipping the rows that caused it
+        Returns:
+            the errors of the rows that could not be inserted
+        """
+        errors = []
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            if atomic:
+                db.session.execute(cls.__table__.insert().values([row for index, row in batch]))
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(cls.__table__.insert().values([row for index, row in batch]))
+            except (IntegrityError, DataError):
+                # retry the batch one row at a time to find the rows that were refused
+                for index, row in batch:
+                    try:
+                        with db.session.begin_nested():
+                            db.session.execute(cls.__table__.insert().values(row))
+                    except IntegrityError:
+                        errors.append({'index': index, 'errors': ROW_CONFLICT})
+                    except DataError as error:
+                        logging.warning('Bulk insert refused row %d: %s', index, error.orig)
+                        errors.append({'index': index, 'errors': ROW_INVALID})
+        return errors
 
     @classmethod
-    def find_by_product_id_and_type(cls, prod_id, rec_type):
-        """ Find all Recommendations by Product Id and Type """
+    def validate_set(cls, items):
+        """
+        Validates the recommendation set of one product and type
+
+        Args:
+            items (list): {'rec_product_id': <int>, 'weight': <float>} dictionaries
+        Returns:
+            the set as a {rec_product_id: weight} dictionary
+        Raises:
+            DataValidationError: if an item is invalid or a product appears twice
+        """
+        if not isinstance(items, list):
+            raise DataValidationError('Recommendation set must be a JSON array')
+        weights = {}
+        for index, data in enumerate(items):
+            if not isinstance(data, dict) or not cls.__set_validator.validate(data):
+                raise DataValidationError('Invalid recommendation at index %d: %s'
+                                          % (index, cls.__set_validator.errors))
+            if data['rec_product_id'] in weights:
+                raise DataValidationError('Product %d is recommended more than once'
+                                          % data['rec_product_id'])
+            weights[data['rec_product_id']] = float(data['weight'])
+        return weights
+
+    @classmethod
+    def validate_lookup(cls, data):
+        """
+        Validates a lookup of the Recommendations of many products
+
+        Args:
+            data (dict): {'product_ids': [<int>, ...], 'type': <str>, 'limit': <int>},
+                         the type and limit are optional
+        Returns:
+            the product ids without duplicates in their first order, the type name and the limit
+        Raises:
+            DataValidationError: if the lookup is invalid
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError('Recommendation lookup must be a JSON object')
+        if not cls.__lookup_validator.validate(data):
+            raise DataValidationError('Invalid recommendation lookup: ' + str(cls.__lookup_validator.errors))
+        product_ids = []
+        for product_id in data['product_ids']:
+            if product_id not in product_ids:
+                product_ids.append(product_id)
+        return product_ids, data.get('type'), data.get('limit')
+
+    @classmethod
+    def replace_set(cls, prod_id, rec_type_id, weights):
+        """
+        Replaces every Recommendation of a product and type, without committing
+
+        The rows are written with one INSERT ... ON CONFLICT DO UPDATE on the
+        (product_id, rec_type_id, rec_product_id) constraint, and the rows that
+        are no longer in the set are removed with one DELETE, so committing
+        both statements together swaps the whole set at once. Databases other
+        than Postgres read the existing set first and then update and insert.
+
+        Args:
+            weights (dict): rec_product_id -> weight of the new set
+        Returns:
+            the number of rows deleted
+        """
+        now = datetime.utcnow()
+        if weights and db.session.get_bind().dialect.name != 'postgresql':
+            cls._write_set(prod_id, rec_type_id, weights, now)
+        elif weights:
+            insert = postgresql.insert(cls.__table__).values(
+                [{'created': now, 'updated': now, 'product_id': prod_id, 'rec_type_id': rec_type_id,
+                  'rec_product_id': rec_product_id, 'weight': weight}
+                 for rec_product_id, weight in sorted(weights.iteritems())])
+            db.session.execute(insert.on_conflict_do_update(
+                constraint='uq_recommendation_product_type_rec_product',
+                set_={'weight': insert.excluded.weight, 'updated': insert.excluded.updated}))
+
+        stale = cls.query.filter(cls.product_id == prod_id, cls.rec_type_id == rec_type_id)
+        if weights:
+            stale = stale.filter(~cls.rec_product_id.in_(weights.keys()))
+        return stale.delete(synchronize_session=False)
+
+    @classmethod
+    def _write_set(cls, prod_id, rec_type_id, weights, now):
+        """ Updates the rows of a set that exist and inserts the others, for databases without ON CONFLICT """
+        table = cls.__table__
+        existing = set(rec_product_id for (rec_product_id,) in
+                       db.session.query(cls.rec_product_id)
+                       .filter(cls.product_id == prod_id, cls.rec_type_id == rec_type_id,
+                               cls.rec_product_id.in_(weights.keys())))
+        if existing:
+            update = (table.update()
+                      .where(and_(table.c.product_id == prod_id, table.c.rec_type_id == rec_type_id,
+                                  table.c.rec_product_id == bindparam('set_rec_product_id')))
+                      .values(weight=bindparam('set_weight'), updated=now))
+            db.session.execute(update, [{'set_rec_product_id': rec_product_id, 'set_weight': weights[rec_product_id]}
+                                        for rec_product_id in sorted(existing)])
+        missing = sorted(set(weights) - existing)
+        if missing:
+            db.session.execute(table.insert().values(
+                [{'created': now, 'updated': now, 'product_id': prod_id, 'rec_type_id': rec_type_id,
+                  'rec_product_id': rec_product_id, 'weight': weights[rec_product_id]}
+                 for rec_product_id in missing]))
+
+    @classmethod
+    def paginate(cls, query, limit=None, after=None, ranked=False):
+        """
+        Applies keyset pagination to a Recommendation query
+
+        Args:
+            limit (int): the maximum number of rows to return
+            after: the key of the last row of the previous page, the id or,
+                   for ranked queries, a (weight, id) tuple
+            ranked (bool): order by weight (highest first) and then id instead of by id
+        """
+        if ranked:
+            query = query.order_by(cls.weight.desc(), cls.id)
+            if after is not None:
+                weight, last_id = after
+                query = query.filter(or_(cls.weight < weight,
+                                         and_(cls.weight == weight, cls.id > last_id)))
+        else:
+            query = query.order_by(cls.id)
+            if after is not None:
+                query = query.filter(cls.id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    @replica_read
+    def find_all(cls, limit=None, after=None):
+        """ Find all Recommendations ordered by id, one page at a time """
+        return cls.paginate(cls.query, limit, after).all()
+
+    @classmethod
+    def stream(cls, prod_id=None, rec_type=None, limit=None, after=None, batch_size=500):
+        """
+        Iterates over Recommendations through a server side cursor
+
+        Filters and orders like the finders, but only batch_size rows are
+        held in memory at a time instead of the whole result
+        """
+        if prod_id is None and rec_type is None:
+            query = cls.query
+        else:
+            query = cls.active_query()
+            if prod_id is not None:
+                query = query.filter(cls.product_id == int(prod_id))
+            if rec_type is not None:
+                query = query.filter(cls.rec_type_id == rec_type.id)
+        return cls.paginate(query, limit, after, ranked=prod_id is not None).yield_per(batch_size)
+
+    @classmethod
+    def active_query(cls):
+        """ Query of the Recommendations whose type is active, joined to their type """
         return (cls.query
-                .filter_by(product_id=int(prod_id))
-                .filter(cls.rec_type.has(RecommendationType.id == rec_type.id))
-                .filter(cls.rec_type.has(RecommendationType.is_active == True))).all()
+                .join(RecommendationType, cls.rec_type_id == RecommendationType.id)
+                .options(contains_eager(cls.rec_type))
+                .filter(RecommendationType.is_active == True))
+
+    @classmethod
+    @replica_read
+    def find_by_product_id(cls, prod_id, limit=None, after=None):
+        """ Find all Recommendations by Product Id, highest weight first """
+        return cls.paginate(cls.active_query()
+                            .filter(cls.product_id == int(prod_id)),
+                            limit, after, ranked=True).all()
+
+    @classmethod
+    @replica_read
+    def find_by_type(cls, rec_type, limit=None, after=None):
+        """ Find all Recommendations by Recommenation Type """
+        return cls.paginate(cls.active_query()
+                            .filter(cls.rec_type_id == rec_type.id),
+                            limit, after).all()
+
+    @classmethod
+    @replica_read
+    def find_by_product_id_and_type(cls, prod_id, rec_type, limit=None, after=None):
+        """ Find all Recommendations by Product Id and Type, highest weight first """
+        return cls.paginate(cls.active_query()
+                            .filter(cls.product_id == int(prod_id))
+                            .filter(cls.rec_type_id == rec_type.id),
+                            limit, after, ranked=True).all()
+
+    @classmethod
+    @replica_read
+    def find_top(cls, prod_id, rec_type=None, limit=10, min_weight=None):
+        """
+        Find the limit best Recommendations of a Product Id, highest weight first
+
+        Ties are ordered by the recommended product, like the read path index,
+        so with a type the rows are read in index order and the scan stops
+        after limit rows instead of sorting all of them.
+        """
+        query = cls.active_query().filter(cls.product_id == int(prod_id))
+        if rec_type is not None:
+            query = query.filter(cls.rec_type_id == rec_type.id)
+        if min_weight is not None:
+            query = query.filter(cls.weight >= min_weight)
+        return (query.order_by(cls.weight.desc(), cls.rec_product_id, cls.id)
+                .limit(limit).all())
+
+    @classmethod
+    @replica_read
+    def find_by_product_ids(cls, prod_ids, rec_type=None, limit=None):
+        """
+        Find the Recommendations of many Product Ids in one query, highest weight first
+
+        Returns a dictionary of lists by product id. With a limit, at most that
+        many Recommendations of each product are returned, ranked in SQL by a
+        row_number() window over the rows of each product.
+        """
+        criteria = [cls.product_id.in_([int(prod_id) for prod_id in prod_ids])]
+        if rec_type is not None:
+            criteria.append(cls.rec_type_id == rec_type.id)
+
+        if limit is None:
+            query = cls.active_query().filter(*criteria)
+        else:
+            rank = func.row_number().over(partition_by=cls.product_id,
+                                          order_by=(cls.weight.desc(), cls.id))
+            ranked = (db.session.query(cls.id.label('id'), rank.label('rank'))
+                      .join(RecommendationType, cls.rec_type_id == RecommendationType.id)
+                      .filter(RecommendationType.is_active == True)
+                      .filter(*criteria)
+                      .subquery())
+            query = (cls.query
+                     .join(ranked, ranked.c.id == cls.id)
+                     .filter(ranked.c.rank <= limit))
+
+        recs = {}
+        for rec in query.order_by(cls.product_id, cls.weight.desc(), cls.id):
+            recs.setdefault(rec.product_id, []).append(rec)
+        return recs
+
+# Read path index for the product finders, ordered so the best weights come first.
+# rec_product_id and id are trailing keys so the index covers the serialized columns.
+Index('ix_recommendation_product_type_weight',
+      Recommendation.product_id,
+      Recommendation.rec_type_id,
+      Recommendation.weight.desc(),
+      Recommendation.rec_product_id,
+      Recommendation.id)
 
 #################################################################################
 #  E L E P H A N T S Q L   D A T A B A S E   C O N N E C T I O N   M E T H O D S
@@ -228,7 +631,10 @@ def init_db():
 
     try:
         db.create_all()
+        upgrade_schema()
 
+        # a lagging replica could look empty and have the primary seeded twice
+        db.session().use_primary()
         if len(RecommendationType.all()) == 0:
             seed_db()
 
@@ -236,8 +642,72 @@ def init_db():
         logging.fatal(e.message)
         raise OperationalError(e.message)
 
+def upgrade_schema(engine=None):
+    """
+    Adds the unique constraint and read path index to a recommendation table created before them
+
+    create_all() skips tables that exist, so this brings older databases up to
+    date and does nothing on current ones. Duplicate rows would make the unique
+    constraint fail, so all but the newest row of each product, type and
+    recommended product are deleted first. SQLite cannot add a constraint to a
+    table and gets a unique index of the same name.
+    """
+    engine = engine or db.engine
+    table = Recommendation.__table__
+    with engine.connect() as connection:
+        inspector = inspect(connection)
+        names = set(constraint['name'] for constraint in inspector.get_unique_constraints(table.name))
+        names.update(index['name'] for index in inspector.get_indexes(table.name))
+        missing = [index for index in table.indexes if index.name not in names]
+        if 'uq_recommendation_product_type_rec_product' in names and not missing:
+            return
+        with connection.begin():
+            _add_constraint_and_indexes(connection, names, missing)
+
+def _add_constraint_and_indexes(connection, names, missing):
+    """ Runs the DDL of upgrade_schema() on a connection in a transaction """
+    table = Recommendation.__table__
+    if 'uq_recommendation_product_type_rec_product' not in names:
+        newest = (select([func.max(table.c.id)])
+                  .group_by(table.c.product_id, table.c.rec_type_id, table.c.rec_product_id))
+        deleted = connection.execute(table.delete().where(~table.c.id.in_(newest))).rowcount
+        logging.info("Adding the recommendation unique constraint, %d duplicate rows removed", deleted)
+        unique = [constraint for constraint in table.constraints
+                  if constraint.name == 'uq_recommendation_product_type_rec_product'][0]
+        if connection.dialect.name == 'postgresql':
+            connection.execute(AddConstraint(unique))
+        else:
+            connection.execute('CREATE UNIQUE INDEX {} ON {} ({})'.format(
+                unique.name, table.name, ', '.join(column.name for column in unique.columns)))
+
+    for index in missing:
+        logging.info("Adding the recommendation index %s", index.name)
+        index.create(bind=connection)
+
 def seed_db():
     logging.info("Seeding database tables")
-    RecommendationType(Name='up-sell', active=True, query='category=values').save()
-    RecommendationType(Name='accessory', active=True, query='category=values').save()
-    RecommendationType(Name='cross-sell', active=False, query='category=values').save()
+    with transaction():
+        RecommendationType(Name='up-sell', active=True, query='category=values').save()
+        RecommendationType(Name='accessory', active=True, query='category=values').save()
+        RecommendationType(Name='cross-sell', active=False, query='category=values').save()
+
+def reset_db():
+    """
+    Empties the tables without rebuilding the schema
+
+    The Recommendation Types are seeded again and the id sequences restart,
+    so the database looks freshly initialized.
+    """
+    with transaction():
+        Recommendation.remove_all()
+        RecommendationType.remove_all()
+        restart_sequences()
+    seed_db()
+
+def restart_sequences():
+    """ Restarts the Postgres id sequences after the highest id in use, other databases reuse ids on their own """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    for table in db.metadata.sorted_tables:
+        db.session.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), COALESCE(MAX(id), 0) + 1, false) "
+                           "FROM {0}".format(table.name))
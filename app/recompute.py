@@ -0,0 +1,314 @@
+"""
+Full Catalog Recompute Job
+
+Scores every anchor product of a catalog file against the whole catalog with
+the Engine and writes the resulting weights to the recommendation table.
+
+The anchors are split into chunks that are scored by a multiprocessing pool
+sized to the machine's cores. The parent process writes each finished chunk
+in bulk and then records its anchors in a checkpoint file, so an interrupted
+job picks up where it stopped when it is run again.
+
+A single product change does not need a full rebuild, applyProductDelta
+rewrites only the rows whose weight can change under the engine's rules.
+
+Catalog file
+------------
+Either a JSON array of products or NDJSON (one product per line), where every
+product has at least an id, a category and a price:
+    {"id": 1, "name": "socks", "category": "footwear", "price": "4.50"}
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+import numpy as np
+from engine import Engine, MetaDataCache, ParsedProduct, SCORER_RULES, buildCandidateColumns, scorer_registry
+from sqlalchemy import and_, or_
+from models import db, Recommendation, RecommendationType, init_db, transaction
+from cache import response_cache
+from . import app
+
+# Filled in by _initWorker in every pool process
+_worker = {}
+
+def loadCatalog(path):
+    """
+    Returns the products of a JSON array or NDJSON catalog file as JSON strings
+
+    Every record is parsed once up front, and a record without a numeric id,
+    a category or a price is logged and skipped, so that it cannot abort the
+    job. A product id that appears more than once keeps its last record, at
+    the position of its first one, so no anchor is scored or written twice.
+    """
+    with open(path) as catalog_file:
+        first = catalog_file.read(1024).lstrip()[:1]
+        catalog_file.seek(0)
+        if first == '[':
+            products = [json.dumps(product) for product in json.load(catalog_file)]
+        else:
+            products = [line.strip() for line in catalog_file if line.strip()]
+
+    positions = {}
+    unique = []
+    for line, product in enumerate(products, 1):
+        try:
+            product_id = int(ParsedProduct.fromMetaData(product).id)
+        except (ValueError, KeyError, TypeError) as error:
+            logging.warning("Skipping invalid product %d of %s: %r", line, path, error)
+            continue
+        if product_id in positions:
+            unique[positions[product_id]] = product
+        else:
+            positions[product_id] = len(unique)
+            unique.append(product)
+    return unique
+
+def readCheckpoint(path):
+    """ Returns the ids of the anchors that a previous run already wrote """
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint:
+        return set(int(line) for line in checkpoint if line.strip())
+
+def _initWorker(catalog, rec_types):
+    """ Builds the candidate columns once per pool process """
+    scorer_registry.load(rec_types)
+    cache = MetaDataCache(maxsize=max(len(catalog), 1))
+    ids, categories, prices, codes = buildCandidateColumns(catalog, cache=cache)
+    _worker.update(catalog=catalog, cache=cache, ids=np.array([int(i) for i in ids]),
+                   categories=categories, prices=prices, codes=codes,
+                   rec_type_ids=[type_id for type_id, name in rec_types])
+
+def scoreChunk(anchor_indexes):
+    """
+    Scores a chunk of anchors against the whole catalog
+
+    Returns the anchor ids, the rows with a positive weight and the number of pairs scored
+    """
+    ids = _worker['ids']
+    anchor_ids = []
+    rows = []
+    pairs = 0
+    for index in anchor_indexes:
+        anchor_id = int(ids[index])
+        anchor_ids.append(anchor_id)
+        for rec_type_id in _worker['rec_type_ids']:
+            engine = Engine(_worker['catalog'][index], rec_type_id, cache=_worker['cache'])
+            weights = engine.scoreCandidates(_worker['categories'], _worker['prices'], _worker['codes'])
+            weights[index] = 0
+            pairs += len(weights) - 1
+            for position in np.flatnonzero(weights > 0):
+                rows.append({'product_id': anchor_id,
+                             'rec_type_id': rec_type_id,
+                             'rec_product_id': int(ids[position]),
+                             'weight': float(weights[position])})
+    return anchor_ids, rows, pairs
+
+def writeChunk(anchor_ids, rec_type_ids, rows):
+    """ Replaces the rows of a chunk of anchors in one transaction with a bulk insert """
+    with transaction():
+        (Recommendation.query
+         .filter(Recommendation.product_id.in_(anchor_ids))
+         .filter(Recommendation.rec_type_id.in_(rec_type_ids))
+         .delete(synchronize_session=False))
+        if rows:
+            db.session.execute(Recommendation.__table__.insert(), rows)
+    response_cache.invalidate_many([(anchor_id, rec_type_id) for anchor_id in anchor_ids
+                                    for rec_type_id in rec_type_ids])
+
+def recompute(catalog_path, rec_types, checkpoint_path=None, processes=None,
+              chunk_size=100, writer=writeChunk):
+    """
+    Recomputes the weights of every anchor in a catalog file
+
+    catalog_path    - JSON array or NDJSON catalog file
+    rec_types       - (id, name) pairs of the recommendation types to compute
+    checkpoint_path - file that records finished anchors, anchors in it are skipped
+    processes       - pool size, defaults to the number of cores
+    chunk_size      - number of anchors scored and written together
+    writer          - called with (anchor ids, rec type ids, rows) for every chunk
+
+    Returns a dict with the anchors, pairs and rows processed, the elapsed
+    seconds and the throughput in pairs per second
+    """
+    catalog = loadCatalog(catalog_path)
+    done = readCheckpoint(checkpoint_path)
+    ids, categories, prices, codes = buildCandidateColumns(catalog, cache=MetaDataCache(maxsize=max(len(catalog), 1)))
+    pending = [index for index, product_id in enumerate(ids) if int(product_id) not in done]
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    rec_type_ids = [type_id for type_id, name in rec_types]
+
+    logging.info("Recomputing %d of %d anchors in %d chunks (%d already done)",
+                 len(pending), len(catalog), len(chunks), len(catalog) - len(pending))
+
+    stats = {'anchors': 0, 'pairs': 0, 'rows': 0}
+    started = time.time()
+    pool = multiprocessing.Pool(processes=processes or multiprocessing.cpu_count(),
+                                initializer=_initWorker, initargs=(catalog, list(rec_types)))
+    checkpoint = open(checkpoint_path, 'a') if checkpoint_path else None
+    try:
+        for anchor_ids, rows, pairs in pool.imap_unordered(scoreChunk, chunks):
+            writer(anchor_ids, rec_type_ids, rows)
+            if checkpoint:
+                checkpoint.write(''.join('%d\n' % anchor_id for anchor_id in anchor_ids))
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+
+            stats['anchors'] += len(anchor_ids)
+            stats['pairs'] += pairs
+            stats['rows'] += len(rows)
+            elapsed = time.time() - started
+            logging.info("%d/%d anchors, %d pairs, %.0f pairs/sec",
+                         stats['anchors'], len(pending), stats['pairs'],
+                         stats['pairs'] / elapsed if elapsed else 0)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if checkpoint:
+            checkpoint.close()
+
+    stats['seconds'] = time.time() - started
+    stats['pairs_per_second'] = stats['pairs'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+######################################################################
+#  I N C R E M E N T A L   U P D A T E S
+######################################################################
+def computeProductDelta(index, product, rec_types):
+    """
+    Works out the pairs whose weight can change when a product changes
+
+    index     - CatalogIndex of the catalog before the change, it is updated in place
+    product   - the new ParsedProduct or product JSON string
+    rec_types - (id, name) pairs of the recommendation types to update
+
+    Only rules that compare categories and price order are supported, so the
+    pairs that can change are the ones with the old or new category, or with
+    a price between the old and new price (where the price order flips).
+    A new product is compared against the whole catalog.
+
+    Returns {(product_id, rec_type_id, rec_product_id): weight} for every
+    affected pair in both directions, including pairs whose weight is now 0
+    """
+    for type_id, name in rec_types:
+        if SCORER_RULES.get(name, {}).get('price') not in ('higher', 'lower'):
+            raise ValueError("Incremental updates are not supported for '%s' recommendations" % name)
+
+    new = index.toProduct(product)
+    old = index.get(new.id)
+    index.add(new)
+    if old is None:
+        affected = set(index.products)
+    else:
+        affected = set(index.productsInCategory(old.category))
+        affected.update(index.productsInCategory(new.category))
+        affected.update(index.productsPricedBetween(min(old.price, new.price), max(old.price, new.price)))
+    affected.discard(new.id)
+
+    weights = {}
+    for type_id, name in rec_types:
+        score = scorer_registry.get(type_id).score
+        for product_id in affected:
+            other = index.get(product_id)
+            weights[(int(new.id), type_id, int(other.id))] = score(new, other)
+            weights[(int(other.id), type_id, int(new.id))] = score(other, new)
+    return weights
+
+def applyProductDelta(index, product, rec_types):
+    """
+    Rewrites the Recommendation rows affected by a product change in one transaction
+
+    Takes the same arguments as computeProductDelta. Rows whose weight
+    dropped to 0 are deleted, changed weights are updated and new positive
+    weights are inserted. Returns the number of rows touched. When the
+    transaction fails the index is put back, so it keeps matching the database.
+    """
+    product = index.toProduct(product)
+    old = index.get(product.id)
+    try:
+        weights = computeProductDelta(index, product, rec_types)
+        touched = _writeProductDelta(int(product.id), weights, rec_types) if weights else set()
+    except:
+        if old is None:
+            index.remove(product.id)
+        else:
+            index.add(old)
+        raise
+    response_cache.invalidate_many(set(key[:2] for key in touched))
+    return len(touched)
+
+def _writeProductDelta(product_id, weights, rec_types):
+    """ Applies the weights of computeProductDelta, returns the keys of the rows touched """
+    others = set(key[2] for key in weights if key[0] == product_id)
+    touched = set()
+    with transaction():
+        rows = (Recommendation.query
+                .filter(Recommendation.rec_type_id.in_([type_id for type_id, name in rec_types]))
+                .filter(or_(and_(Recommendation.product_id == product_id,
+                                 Recommendation.rec_product_id.in_(others)),
+                            and_(Recommendation.product_id.in_(others),
+                                 Recommendation.rec_product_id == product_id)))).all()
+
+        for row in rows:
+            key = (row.product_id, row.rec_type_id, row.rec_product_id)
+            weight = weights.pop(key, 0)
+            if weight <= 0:
+                db.session.delete(row)
+                touched.add(key)
+            elif row.weight != weight:
+                row.weight = float(weight)
+                touched.add(key)
+
+        for (anchor_id, rec_type_id, other_id), weight in weights.iteritems():
+            if weight > 0:
+                db.session.add(Recommendation(product_id=anchor_id, rec_type_id=rec_type_id,
+                                              rec_product_id=other_id, weight=float(weight)))
+                touched.add((anchor_id, rec_type_id, other_id))
+    return touched
+
+######################################################################
+#   M A I N
+######################################################################
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description='Recompute recommendation weights for a product catalog')
+    parser.add_argument('catalog', help='JSON array or NDJSON product catalog file')
+    parser.add_argument('--type', action='append', dest='types',
+                        help='recommendation type name, may be repeated (default: all active types)')
+    parser.add_argument('--checkpoint', help='checkpoint file (default: <catalog>.checkpoint)')
+    parser.add_argument('--restart', action='store_true', help='ignore and replace an existing checkpoint')
+    parser.add_argument('--processes', type=int, help='pool size (default: number of cores)')
+    parser.add_argument('--chunk-size', type=int, default=100, help='anchors per chunk (default: 100)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s in %(module)s: %(message)s')
+    init_db()
+    scorer_registry.load(RecommendationType.all())
+    # the servers learn about the rewritten rows through the shared cache backend
+    response_cache.connect(app.config.get('RESPONSE_CACHE_BACKEND'))
+
+    if args.types:
+        rec_types = [RecommendationType.find_by_name(name) for name in args.types]
+        missing = [name for name, rec_type in zip(args.types, rec_types) if rec_type is None]
+        if missing:
+            parser.error('unknown or inactive recommendation type: %s' % ', '.join(missing))
+    else:
+        rec_types = RecommendationType.query.filter_by(is_active=True).all()
+    rec_types = [(rec_type.id, rec_type.name) for rec_type in rec_types if rec_type.id in scorer_registry]
+
+    checkpoint_path = args.checkpoint or args.catalog + '.checkpoint'
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    stats = recompute(args.catalog, rec_types, checkpoint_path, args.processes, args.chunk_size)
+    logging.info("Done: %(anchors)d anchors, %(pairs)d pairs, %(rows)d rows in %(seconds).1fs "
+                 "(%(pairs_per_second).0f pairs/sec)", stats)
+    return 0
@@ -3,25 +3,38 @@ Recommendation Service
 
 Paths:
 ------
-GET /recommendations - Returns a list all of previously created recommendations
+GET /recommendations - Returns a page of previously created recommendations
+                       (or streams all of them with ?stream=1 or Accept: application/x-ndjson)
 GET /recommendations/{id} - Returns the Recommendations with a given id number
 POST /recommendations - creates a new Recommendation record in the database
+POST /recommendations/bulk - creates many Recommendation records from a JSON array or NDJSON
+POST /recommendations/lookup - Returns the Recommendations of many products at once
+PUT /recommendations/products/{product_id}/{rec_type_id} - replaces the recommendations of a product and type
+GET /recommendations/cache - Returns the response cache statistics of this instance
 PUT /recommendations/{id} - updates an existing Recommendations record in the database
 DELETE /recommendations/{id} - deletes a Recommendations record in the database
+GET /products/{product_id}/recommendations - Returns the best Recommendations of a product by weight
 """
 
 import os
 import sys
+import base64
+import urllib
 import logging
 import requests
-from flask import Flask, jsonify, request, url_for, make_response, json, render_template
+from flask import Flask, Response, jsonify, request, url_for, make_response, json, render_template, stream_with_context
 from flask_api import status    # HTTP Status Codes
-from flask_restplus import Resource
-from werkzeug.exceptions import NotFound
-from models import Recommendation, RecommendationType, init_db, DataValidationError, db
-from engine import Engine
+from flask_restplus import Resource, marshal
+from werkzeug.exceptions import NotFound, BadRequest, Conflict
+from werkzeug.http import quote_etag, generate_etag
+from sqlalchemy.exc import IntegrityError, DataError
+from models import Recommendation, RecommendationType, init_db, reset_db, DataValidationError, db, transaction
+from models import ROW_CONFLICT, ROW_INVALID, INT_MIN, INT_MAX
+from engine import Engine, scorer_registry
+from cache import response_cache
 from . import app
-from swagger import api, ns, recommendation_model, expected_create_model
+from swagger import api, ns, products_ns, recommendation_model, expected_create_model, expected_set_model
+from swagger import expected_lookup_model, lookup_result_model
 
 @app.template_global()
 def static_include(filename):
@@ -33,6 +46,29 @@ def static_include(filename):
 def initialize_db():
     """ Initialize the model """
     init_db()
+    db.session().use_primary()
+    scorer_registry.load(RecommendationType.all())
+    # this runs before the first request, which should route its reads again
+    db.session.remove()
+
+# POST endpoints that only read
+READ_ONLY_ENDPOINTS = ('lookup_recommendations',)
+
+@app.before_request
+def read_own_writes():
+    """ Requests that change data read from the primary, never from a lagging replica """
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and request.endpoint not in READ_ONLY_ENDPOINTS:
+        db.session().use_primary()
+
+@app.before_request
+def connect_response_cache():
+    """
+    Attaches the response cache to the shared backend, writes publish their invalidations to it
+
+    While the backend is unreachable the cache stays local and the connection
+    is retried with a backoff, the request is served either way.
+    """
+    response_cache.connect(app.config.get('RESPONSE_CACHE_BACKEND'))
 
 @ns.route('/<int:recommendation_id>')
 @ns.param('recommendation_id', 'The Recommendation identifier')
@@ -41,12 +77,15 @@ class RecommendationResource(Resource):
     # RETRIEVE A RECOMMENDATION
     ######################################################################
     @ns.doc('get_recommendations')
+    @ns.response(200, 'Success', recommendation_model)
+    @ns.response(304, 'No Recommendation changed since the ETag in If-None-Match')
     @ns.response(404, 'Recommendation not found')
-    @ns.marshal_with(recommendation_model)
     def get(self, recommendation_id):
         """ Retrieve a single Recommendation
 
-        This endpoint will return a Recommendations based on it's id
+        This endpoint will return a Recommendations based on it's id. Its ETag
+        is computed from the Recommendation itself, a request whose
+        If-None-Match holds the current one is answered with 304.
         """
         recommendation = Recommendation.find_by_id(recommendation_id)
 
@@ -54,9 +93,15 @@ class RecommendationResource(Resource):
         if not recommendation:
             raise NotFound("Recommendations with id '{}' was not found.".format(recommendation_id))
         else:
-            recJSON = recommendation.serialize()
+            recJSON = marshal(recommendation.serialize(), recommendation_model)
 
-        return recJSON, status.HTTP_200_OK
+        # the row is read by its primary key anyway, so its ETag comes from the
+        # row and holds whichever process or job last wrote it
+        etag = content_etag(recJSON)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        return recJSON, status.HTTP_200_OK, etag_headers(etag)
 
     ######################################################################
     # UPDATE AN EXISTING RECOMMENDATION
@@ -64,6 +109,7 @@ class RecommendationResource(Resource):
     @ns.doc('update_recommendation')
     @ns.response(404, 'Recommendation not found')
     @ns.response(400, 'The posted Recommendation data was not valid')
+    @ns.response(409, 'The product already has this Recommendation')
     @ns.expect(expected_create_model)
     @ns.marshal_with(recommendation_model)
     def put(self, recommendation_id):
@@ -76,9 +122,16 @@ class RecommendationResource(Resource):
         if not recommendation:
             raise NotFound("Recommendation with id '{}' was not found.".format(recommendation_id))
 
-        recommendation.deserialize(request.get_json())
-        recommendation.id = recommendation_id
-        recommendation.save()
+        previous = (recommendation.product_id, recommendation.rec_type_id)
+        try:
+            with transaction():
+                recommendation.deserialize(request.get_json())
+                check_rec_type(recommendation)
+                recommendation.id = recommendation_id
+                recommendation.save()
+        except IntegrityError:
+            raise Conflict("The product already has this Recommendation.")
+        response_cache.invalidate_many([previous, (recommendation.product_id, recommendation.rec_type_id)])
 
         return recommendation.serialize(), status.HTTP_200_OK
 
@@ -98,7 +151,9 @@ class RecommendationResource(Resource):
         if not recommendation:
             raise NotFound("Recommendation with id '{}' was not found.".format(recommendation_id))
 
-        recommendation.delete()
+        with transaction():
+            recommendation.delete()
+        response_cache.invalidate(recommendation.product_id, recommendation.rec_type_id)
 
         return '', status.HTTP_204_NO_CONTENT
 
@@ -110,33 +165,87 @@ class RecommendationCollection(Resource):
     @ns.doc('list_recs')
     @ns.param('type', 'Get Recommendation By Type (i.e. up-sell, accessory, cross-sell, etc)')
     @ns.param('product_id', 'Get Recommendation By Product Id')
+    @ns.param('limit', 'The maximum number of Recommendations to return')
+    @ns.param('cursor', 'The cursor of the next page, from the Link header of the previous page')
+    @ns.param('stream', 'Set to 1 to stream every result instead of returning one page')
+    @ns.response(200, 'Success', [recommendation_model])
+    @ns.response(304, 'The Recommendations did not change since the ETag in If-None-Match')
+    @ns.response(400, 'The limit or cursor was not valid')
     @ns.response(500, 'There was an issue resolving your request')
-    @ns.marshal_list_with(recommendation_model)
     def get(self):
-        """ Returns all Recommendations """
+        """ Returns a page of Recommendations
+
+        Recommendations for a product are ordered by weight (highest first),
+        all others by id. When there may be more results a Link header with
+        rel="next" points to the next page.
+
+        With stream=1, or an Accept header of application/x-ndjson, every
+        result is streamed as a JSON array, or as one JSON object per line,
+        while it is read from the database. Pages, but not streams, are
+        served from the response cache when it is enabled.
+
+        With a shared response cache backend, pages carry an ETag that changes
+        with every write of the product and type queried, a request whose
+        If-None-Match holds the current one is answered with 304 before the
+        Recommendations are read.
+        """
 
         type_name = request.args.get('type')
         product_id = request.args.get('product_id')
+        ndjson = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+        stream = ndjson or request.args.get('stream') in ('1', 'true')
+        limit = get_page_size(unbounded=stream)
+        ranked = bool(product_id)
+        after = decode_cursor(request.args.get('cursor'), ranked)
         results = []
         rec_type = None
 
+        cache = None if stream else get_response_cache()
+        key = list_cache_key(product_id, type_name, limit, after)
+        if cache is not None and key:
+            cached = cache.get(key)
+            if cached is not None:
+                results, cursor, etag = cached
+                response = not_modified(etag)
+                if response is not None:
+                    return response
+                return results, status.HTTP_200_OK, page_headers(cursor, limit, etag)
+            version = cache.version()
+
         if type_name:
             rec_type = RecommendationType.find_by_name(type_name)
             if not rec_type:
                 raise NotFound("Recommendations with type '{}' was not found.".format(type_name))
 
+        if stream:
+            recs = Recommendation.stream(product_id or None, rec_type, limit, after)
+            return stream_response(recs, ndjson)
+
+        # read before the Recommendations, a write in between changes it again
+        etag = response_cache.etag(key[0], rec_type.id if rec_type else None) if key else None
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        if etag is not None or (cache is not None and key):
+            read_from_primary()
+
         if rec_type and product_id:
-            recs = Recommendation.find_by_product_id_and_type(product_id, rec_type)
+            recs = Recommendation.find_by_product_id_and_type(product_id, rec_type, limit, after)
         elif rec_type:
-            recs = Recommendation.find_by_type(rec_type)
+            recs = Recommendation.find_by_type(rec_type, limit, after)
         elif product_id:
-            recs = Recommendation.find_by_product_id(product_id)
+            recs = Recommendation.find_by_product_id(product_id, limit, after)
         else:
-            recs = Recommendation.all()
+            recs = Recommendation.find_all(limit, after)
+
+        results = marshal([rec.serialize() for rec in recs if rec is not None], recommendation_model)
+        cursor = encode_cursor(recs[-1], ranked) if len(recs) == limit else None
 
-        results = [rec.serialize() for rec in recs if rec is not None]
+        if cache is not None and key:
+            tag = (key[0], rec_type.id if rec_type else None)
+            cache.set(key, (results, cursor, etag), tag, version)
 
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, page_headers(cursor, limit, etag)
 
     ######################################################################
     #  CREATE A RECOMMENDATION
@@ -145,6 +254,7 @@ class RecommendationCollection(Resource):
     @ns.expect(expected_create_model)
     @ns.response(400, 'The posted data was not valid')
     @ns.response(201, 'Recommendation created successfully')
+    @ns.response(409, 'The product already has this Recommendation')
     @ns.marshal_with(recommendation_model, code=201)
     def post(self):
         """ Creates a Recommendation
@@ -158,12 +268,221 @@ class RecommendationCollection(Resource):
         #data = request.get_json()
         rec = Recommendation()
         rec.deserialize(api.payload)
-        rec.save()
+        check_rec_type(rec)
+        try:
+            with transaction():
+                rec.save()
+        except IntegrityError:
+            raise Conflict("The product already has this Recommendation.")
+        response_cache.invalidate(rec.product_id, rec.rec_type_id)
 
         location_url = api.url_for(RecommendationResource, recommendation_id=rec.id, _external=True)
 
         return rec.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
+@ns.route('/bulk')
+class RecommendationBulkResource(Resource):
+    ######################################################################
+    #  CREATE MANY RECOMMENDATIONS
+    ######################################################################
+    @ns.doc('bulk_create_recommendations')
+    @ns.param('atomic', 'Set to 1 to create nothing unless every Recommendation is valid')
+    @ns.response(201, 'Every Recommendation was created')
+    @ns.response(200, 'Some Recommendations were created, see the errors')
+    @ns.response(400, 'No Recommendations were created, see the errors')
+    @ns.response(409, 'An atomic batch conflicted with existing Recommendations')
+    def post(self):
+        """ Creates many Recommendations
+
+        The body is a JSON array of Recommendations, or one Recommendation per
+        line with a Content-Type of application/x-ndjson. Every item is
+        validated and the valid ones are inserted in batches. The response
+        holds the number created and the errors of the rejected items by
+        their position in the body.
+        """
+        atomic = request.args.get('atomic') in ('1', 'true')
+        rows, errors = Recommendation.validate_many(get_bulk_items())
+        if atomic and errors:
+            return {'created': 0, 'errors': errors}, status.HTTP_400_BAD_REQUEST
+
+        try:
+            with transaction():
+                insert_errors = Recommendation.bulk_insert(rows, atomic=atomic)
+        except IntegrityError:
+            return {'created': 0, 'errors': [{'errors': ROW_CONFLICT}]}, status.HTTP_409_CONFLICT
+        except DataError as error:
+            app.logger.warning('Atomic bulk insert refused: %s', error.orig)
+            return {'created': 0, 'errors': [{'errors': ROW_INVALID}]}, status.HTTP_400_BAD_REQUEST
+
+        rejected = set(error['index'] for error in insert_errors)
+        response_cache.invalidate_many(set((row['product_id'], row['rec_type_id'])
+                                           for index, row in rows if index not in rejected))
+
+        created = len(rows) - len(insert_errors)
+        errors = sorted(errors + insert_errors, key=lambda error: error['index'])
+        if not errors:
+            code = status.HTTP_201_CREATED
+        elif created:
+            code = status.HTTP_200_OK
+        else:
+            code = status.HTTP_400_BAD_REQUEST
+        return {'created': created, 'errors': errors}, code
+
+@ns.route('/lookup', endpoint='lookup_recommendations')
+class RecommendationLookupResource(Resource):
+    ######################################################################
+    #  LOOK UP THE RECOMMENDATIONS OF MANY PRODUCTS
+    ######################################################################
+    @ns.doc('lookup_recommendations')
+    @ns.expect(expected_lookup_model)
+    @ns.response(200, 'Success', [lookup_result_model])
+    @ns.response(400, 'The lookup was not valid')
+    @ns.response(404, 'Recommendation Type not found')
+    def post(self):
+        """ Returns the Recommendations of many products
+
+        The body holds the product_ids to look up and optionally a type and
+        the limit of Recommendations per product. They are read in a single
+        query and returned grouped by product, in the order the products
+        were asked for, each product's Recommendations highest weight first.
+        Without a limit every Recommendation of each product is returned, a
+        limit is capped at the maximum page size.
+        """
+        try:
+            product_ids, type_name, limit = Recommendation.validate_lookup(request.get_json(silent=True))
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+        max_products = app.config['RECOMMENDATION_MAX_LOOKUP_PRODUCTS']
+        if len(product_ids) > max_products:
+            raise BadRequest("At most {} products can be looked up at once.".format(max_products))
+
+        rec_type = None
+        if type_name:
+            rec_type = RecommendationType.find_by_name(type_name)
+            if not rec_type:
+                raise NotFound("Recommendations with type '{}' was not found.".format(type_name))
+
+        if limit is not None:
+            limit = min(limit, app.config['RECOMMENDATION_MAX_PAGE_SIZE'])
+        recs = Recommendation.find_by_product_ids(product_ids, rec_type, limit)
+        results = [{'product_id': product_id,
+                    'recommendations': [rec.serialize() for rec in recs.get(product_id, [])]}
+                   for product_id in product_ids]
+        return marshal(results, lookup_result_model), status.HTTP_200_OK
+
+@products_ns.route('/<int:product_id>/recommendations')
+@products_ns.param('product_id', 'The Product identifier')
+class ProductRecommendationsResource(Resource):
+    ######################################################################
+    #  THE BEST RECOMMENDATIONS OF A PRODUCT
+    ######################################################################
+    @products_ns.doc('top_recommendations')
+    @products_ns.param('type', 'Only Recommendations of this type (i.e. up-sell, accessory, cross-sell, etc)')
+    @products_ns.param('limit', 'The number of Recommendations to return')
+    @products_ns.param('min_weight', 'Only Recommendations with at least this weight')
+    @products_ns.response(200, 'Success', [recommendation_model])
+    @products_ns.response(304, 'The Recommendations did not change since the ETag in If-None-Match')
+    @products_ns.response(400, 'The limit or minimum weight was not valid')
+    @products_ns.response(404, 'Recommendation Type not found')
+    def get(self, product_id):
+        """ Returns the best Recommendations of a product
+
+        The Recommendations come highest weight first, at most limit of them.
+        Like GET /recommendations the result carries an ETag when the response
+        cache has a shared backend, and is served from it when it is enabled.
+        """
+        type_name = request.args.get('type')
+        limit = get_page_size(default=app.config['RECOMMENDATION_TOP_SIZE'])
+        min_weight = get_min_weight()
+
+        cache = get_response_cache()
+        key = ('top', product_id, type_name.lower() if type_name else None, limit, min_weight)
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                results, etag = cached
+                response = not_modified(etag)
+                if response is not None:
+                    return response
+                return results, status.HTTP_200_OK, etag_headers(etag)
+            version = cache.version()
+
+        rec_type = None
+        if type_name:
+            rec_type = RecommendationType.find_by_name(type_name)
+            if not rec_type:
+                raise NotFound("Recommendations with type '{}' was not found.".format(type_name))
+        tag = (product_id, rec_type.id if rec_type else None)
+
+        etag = response_cache.etag(*tag)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        if etag is not None or cache is not None:
+            read_from_primary()
+
+        recs = Recommendation.find_top(product_id, rec_type, limit, min_weight)
+        results = marshal([rec.serialize() for rec in recs], recommendation_model)
+        if cache is not None:
+            cache.set(key, (results, etag), tag, version)
+        return results, status.HTTP_200_OK, etag_headers(etag)
+
+@ns.route('/products/<int:product_id>/<int:rec_type_id>')
+@ns.param('product_id', 'The Product identifier')
+@ns.param('rec_type_id', 'The Recommendation Type identifier')
+class RecommendationSetResource(Resource):
+    ######################################################################
+    #  REPLACE THE RECOMMENDATIONS OF A PRODUCT
+    ######################################################################
+    @ns.doc('replace_recommendation_set')
+    @ns.expect([expected_set_model])
+    @ns.response(200, 'Success', [recommendation_model])
+    @ns.response(400, 'The product id or the posted Recommendation set was not valid')
+    @ns.response(404, 'Recommendation Type not found')
+    def put(self, product_id, rec_type_id):
+        """ Replace the Recommendations of a Product
+
+        This endpoint replaces every Recommendation of a product and type with
+        the posted set in one transaction. Recommendations already in the set
+        get their new weight, new ones are created and the ones left out are
+        deleted. Posting an empty array removes them all.
+        """
+        if not INT_MIN <= product_id <= INT_MAX:
+            raise BadRequest("Product id '{}' is out of range.".format(product_id))
+        if not RecommendationType.find_by_id(rec_type_id):
+            raise NotFound("Recommendations with type '{}' was not found.".format(rec_type_id))
+
+        try:
+            weights = Recommendation.validate_set(request.get_json(silent=True))
+        except DataValidationError as error:
+            raise BadRequest(str(error))
+
+        with transaction():
+            Recommendation.replace_set(product_id, rec_type_id, weights)
+        response_cache.invalidate(product_id, rec_type_id)
+
+        recs = (Recommendation.query
+                .filter_by(product_id=product_id, rec_type_id=rec_type_id)
+                .order_by(Recommendation.weight.desc(), Recommendation.id))
+        results = [rec.serialize() for rec in recs]
+        return marshal(results, recommendation_model), status.HTTP_200_OK
+
+@ns.route('/cache')
+class CacheResource(Resource):
+    ######################################################################
+    #  RESPONSE CACHE STATISTICS
+    ######################################################################
+    @ns.doc('response_cache_info')
+    def get(self):
+        """ Returns the response cache statistics
+
+        The hit ratio, size and the hit, miss, eviction, expiration and
+        invalidation counts of the response cache of this instance.
+        """
+        info = response_cache.info()
+        info['enabled'] = bool(app.config.get('RESPONSE_CACHE_ENABLED'))
+        return info, status.HTTP_200_OK
+
 @ns.route('/activate/<int:type_id>')
 @ns.param('type_id', 'The Recommendation activate action')
 class ActivateResource(Resource):
@@ -185,8 +504,10 @@ class ActivateResource(Resource):
         if not rec_type:
             raise NotFound("Recommendations with type '{}' was not found.".format(type_id))
 
-        rec_type.is_active = True
-        rec_type.save()
+        with transaction():
+            rec_type.is_active = True
+            rec_type.save()
+        response_cache.invalidate_type(rec_type.id)
 
         return rec_type.serialize(), status.HTTP_200_OK
 
@@ -209,8 +530,10 @@ class DeactivateResource(Resource):
         if not rec_type:
             raise NotFound("Recommendations with type '{}' was not found.".format(type_id))
 
-        rec_type.is_active = False
-        rec_type.save()
+        with transaction():
+            rec_type.is_active = False
+            rec_type.save()
+        response_cache.invalidate_type(rec_type.id)
 
         return 'Recommendation Type {} is deactivated.\n'.format(type), status.HTTP_200_OK
 
@@ -220,14 +543,163 @@ class DeactivateResource(Resource):
 @app.route('/recommendations/reset', methods=['DELETE'])
 def reset_recommendations():
     """ Removes all recommendations from the database """
-    db.session.remove()
-    db.drop_all()
-    init_db()
+    reset_db()
+    response_cache.clear()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
+def get_page_size(unbounded=False, default=None):
+    """
+    Returns the requested page size, capped at the maximum page size
+
+    Streamed responses are unbounded, they have no default or maximum size.
+    Without a limit the default, or else the configured page size, is used.
+    """
+    max_size = app.config['RECOMMENDATION_MAX_PAGE_SIZE']
+    limit = request.args.get('limit')
+    if limit is None:
+        return None if unbounded else min(default or app.config['RECOMMENDATION_PAGE_SIZE'], max_size)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise BadRequest("Limit '{}' is not a number.".format(limit))
+    if limit < 1:
+        raise BadRequest("Limit must be at least 1.")
+    return limit if unbounded else min(limit, max_size)
+
+def get_min_weight():
+    """ Returns the requested minimum weight, or None """
+    min_weight = request.args.get('min_weight')
+    if min_weight is None:
+        return None
+    try:
+        min_weight = float(min_weight)
+    except ValueError:
+        raise BadRequest("Minimum weight '{}' is not a number.".format(min_weight))
+    if min_weight != min_weight:
+        raise BadRequest("Minimum weight must be a number.")
+    return min_weight
+
+def get_bulk_items():
+    """ Returns the items of a JSON array or NDJSON body, lines that are not JSON become None """
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data().splitlines():
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        return items
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise BadRequest("Expected a JSON array or NDJSON of Recommendations.")
+    return items
+
+def stream_response(recs, ndjson):
+    """ Streams Recommendations as NDJSON or as a JSON array, one record at a time """
+    def generate():
+        separator = ''
+        if not ndjson:
+            yield '['
+        for rec in recs:
+            data = json.dumps(marshal(rec.serialize(), recommendation_model))
+            if ndjson:
+                yield data + '\n'
+            else:
+                yield separator + data
+                separator = ','
+        if not ndjson:
+            yield ']'
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), status=status.HTTP_200_OK, mimetype=mimetype)
+
+def encode_cursor(rec, ranked):
+    """ Returns an opaque cursor that continues after a Recommendation """
+    key = {'w': rec.weight, 'id': rec.id} if ranked else {'id': rec.id}
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+def decode_cursor(cursor, ranked):
+    """ Returns the keyset of a cursor, the id or a (weight, id) tuple for ranked lists """
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if ranked:
+            return float(key['w']), int(key['id'])
+        return int(key['id'])
+    except (TypeError, ValueError, KeyError):
+        raise BadRequest("Cursor '{}' is not valid.".format(cursor))
+
+def page_headers(cursor, limit, etag=None):
+    """ Returns the ETag header and the Link header of the next page, when there is a cursor to it """
+    headers = etag_headers(etag)
+    if cursor:
+        headers['Link'] = '<{}>; rel="next"'.format(next_page_url(cursor, limit))
+    return headers
+
+def etag_headers(etag):
+    """ Returns the ETag header of an entity tag, when there is one """
+    return {'ETag': quote_etag(etag)} if etag else {}
+
+def content_etag(data):
+    """ Returns the entity tag of a marshalled response body """
+    return generate_etag(json.dumps(data, sort_keys=True))
+
+def not_modified(etag):
+    """ Returns a 304 response when the If-None-Match header holds the entity tag, else None """
+    if etag and request.if_none_match.contains_weak(etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=etag_headers(etag))
+    return None
+
+def read_from_primary():
+    """
+    Sends the reads of a request whose result gets an ETag or is cached to the primary
+
+    The version was read from the shared store before the rows, a lagging
+    replica could still return the rows of before the write that set it, and
+    they would be tagged and cached as current until the next write.
+    """
+    if app.config.get('SQLALCHEMY_REPLICAS'):
+        db.session().use_primary()
+
+def check_rec_type(rec):
+    """
+    Refuses a Recommendation whose type does not exist
+
+    The database would reject it as a foreign key violation, an IntegrityError
+    that is otherwise only raised when the product already has the Recommendation.
+    """
+    if RecommendationType.find_by_id(rec.rec_type_id) is None:
+        raise BadRequest("Recommendation type '{}' does not exist.".format(rec.rec_type_id))
+
+def get_response_cache():
+    """ Returns the response cache sized by the config, or None when it is disabled """
+    if not app.config.get('RESPONSE_CACHE_ENABLED'):
+        return None
+    if (response_cache.maxsize, response_cache.ttl) != (app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL']):
+        response_cache.configure(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+    return response_cache
+
+def list_cache_key(product_id, type_name, limit, after):
+    """ Returns the normalized response cache key of a list query, None if it cannot be cached """
+    if product_id and not product_id.isdigit():
+        return None
+    return (int(product_id) if product_id else None,
+            type_name.lower() if type_name else None,
+            limit, after)
+
+def next_page_url(cursor, limit):
+    """ Returns the current URL with the cursor and limit of the next page """
+    args = request.args.to_dict()
+    args['cursor'] = cursor
+    args['limit'] = limit
+    return '{}?{}'.format(request.base_url, urllib.urlencode(sorted(args.items())))
+
 def initialize_logging():
     """ Initialized the default logging to STDOUT """
 
@@ -0,0 +1,254 @@
+"""
+Product Similarity for Cross-sell Recommendations
+
+Encodes product metadata as feature vectors and finds similar products with
+an approximate nearest-neighbour index, so cross-sell candidates for a
+product come back without comparing it to the whole catalog.
+
+Classes
+-------
+FeatureEncoder - product metadata -> unit length feature vector
+                 (category one-hot, standardized log price, optional attribute one-hots)
+LSHIndex       - random-projection (sign) LSH over the feature vectors,
+                 candidates from the matching buckets are re-ranked by exact cosine similarity
+CrossSellIndex - a FeatureEncoder and an LSHIndex built from the same catalog
+
+bruteForce returns the exact answer and recall compares the two, they are used
+by benchmarks/bench_similarity.py.
+"""
+import json
+import numpy as np
+
+
+def _toDict(product):
+    """ Accepts a product dict or a product JSON string """
+    if isinstance(product, dict):
+        return product
+    return json.loads(product)
+
+
+class FeatureEncoder(object):
+    """ Turns product metadata into feature vectors """
+
+    def __init__(self, attributes=(), category_weight=1.0, price_weight=1.0, attribute_weight=0.5):
+        self.attributes = tuple(attributes)
+        self.category_weight = category_weight
+        self.price_weight = price_weight
+        self.attribute_weight = attribute_weight
+        self.categories = {}
+        self.values = {}
+        self.price_mean = 0.0
+        self.price_std = 1.0
+
+    @property
+    def dim(self):
+        """ Length of the encoded vectors """
+        return len(self.categories) + 1 + sum(len(values) for values in self.values.itervalues())
+
+    def fit(self, products):
+        """ Learns the category and attribute vocabularies and the log price scale """
+        products = [_toDict(product) for product in products]
+        categories = sorted(set(product['category'] for product in products))
+        self.categories = dict((category, i) for i, category in enumerate(categories))
+
+        offset = len(self.categories) + 1
+        self.values = {}
+        for attribute in self.attributes:
+            values = sorted(set(product[attribute] for product in products if attribute in product))
+            self.values[attribute] = dict((value, offset + i) for i, value in enumerate(values))
+            offset += len(values)
+
+        log_prices = np.log1p([float(product['price']) for product in products])
+        if len(log_prices):
+            self.price_mean = float(log_prices.mean())
+            self.price_std = float(log_prices.std()) or 1.0
+        return self
+
+    def encode(self, product):
+        """ Returns the unit length feature vector of one product """
+        product = _toDict(product)
+        vector = np.zeros(self.dim, dtype=np.float32)
+
+        category = self.categories.get(product['category'])
+        if category is not None:
+            vector[category] = self.category_weight
+        log_price = np.log1p(float(product['price']))
+        vector[len(self.categories)] = self.price_weight * (log_price - self.price_mean) / self.price_std
+        for attribute in self.attributes:
+            position = self.values[attribute].get(product.get(attribute))
+            if position is not None:
+                vector[position] = self.attribute_weight
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def toDict(self):
+        """ Returns the fitted encoder as JSON friendly data """
+        return {'attributes': list(self.attributes),
+                'weights': [self.category_weight, self.price_weight, self.attribute_weight],
+                'categories': sorted(self.categories.items(), key=lambda item: item[1]),
+                'values': dict((attribute, sorted(values.items(), key=lambda item: item[1]))
+                               for attribute, values in self.values.iteritems()),
+                'price': [self.price_mean, self.price_std]}
+
+    @classmethod
+    def fromDict(cls, data):
+        """ Rebuilds a fitted encoder from toDict data """
+        encoder = cls(data['attributes'], *data['weights'])
+        encoder.categories = dict((category, i) for category, i in data['categories'])
+        encoder.values = dict((attribute, dict((value, i) for value, i in values))
+                              for attribute, values in data['values'].iteritems())
+        encoder.price_mean, encoder.price_std = data['price']
+        return encoder
+
+    def encodeMany(self, products):
+        """ Returns a (products x dim) matrix of feature vectors """
+        products = list(products)
+        matrix = np.zeros((len(products), self.dim), dtype=np.float32)
+        for i, product in enumerate(products):
+            matrix[i] = self.encode(product)
+        return matrix
+
+
+class LSHIndex(object):
+    """ Random-projection LSH index of unit length vectors for cosine similarity """
+
+    def __init__(self, dim, tables=8, bits=12, seed=0):
+        self.dim = dim
+        self.tables = tables
+        self.bits = bits
+        self.seed = seed
+        self.planes = np.random.RandomState(seed).randn(tables, bits, dim).astype(np.float32)
+        self._powers = 1 << np.arange(bits, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self._positions = {}
+        self._buckets = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _keys(self, vectors):
+        """ Returns the (tables x vectors) bucket keys and projections of a vector matrix """
+        projections = np.einsum('tbd,nd->tnb', self.planes, vectors)
+        return np.dot(projections > 0, self._powers), projections
+
+    def build(self, ids, vectors):
+        """ Indexes the vectors of the given product ids, replacing anything indexed before """
+        self.ids = np.asarray(ids)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self._positions = dict((product_id, i) for i, product_id in enumerate(self.ids.tolist()))
+
+        keys, projections = self._keys(self.vectors)
+        self._buckets = []
+        for table_keys in keys:
+            order = np.argsort(table_keys, kind='mergesort')
+            unique, starts = np.unique(table_keys[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            self._buckets.append(dict((key, order[start:end])
+                                      for key, start, end in zip(unique.tolist(), starts, ends)))
+        return self
+
+    def query(self, vector, k, probes=0, exclude=None):
+        """
+        Returns up to k (product id, cosine similarity) tuples, most similar first
+
+        vector  - unit length query vector
+        probes  - extra buckets per table to visit, flipping the bits closest to their plane
+        exclude - a product id to leave out, usually the product being queried
+        """
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        keys, projections = self._keys(vector)
+
+        found = []
+        for table in range(self.tables):
+            key = int(keys[table, 0])
+            table_keys = [key]
+            if probes:
+                closest = np.argsort(np.abs(projections[table, 0]))[:probes]
+                table_keys.extend(key ^ int(self._powers[bit]) for bit in closest)
+            for table_key in table_keys:
+                bucket = self._buckets[table].get(table_key)
+                if bucket is not None:
+                    found.append(bucket)
+
+        if not found:
+            return []
+        candidates = np.unique(np.concatenate(found))
+        if exclude is not None and exclude in self._positions:
+            candidates = candidates[candidates != self._positions[exclude]]
+        return self._rank(candidates, np.dot(self.vectors[candidates], vector[0]), k)
+
+    def queryById(self, product_id, k, probes=0):
+        """ Returns the k products most similar to an indexed product, leaving the product out """
+        return self.query(self.vectors[self._positions[product_id]], k, probes, exclude=product_id)
+
+    def _rank(self, rows, similarities, k):
+        if len(rows) > k:
+            best = np.argpartition(-similarities, k - 1)[:k]
+            rows, similarities = rows[best], similarities[best]
+        order = np.lexsort((self.ids[rows], -similarities))
+        return [(self.ids[rows[i]].item(), float(similarities[i])) for i in order]
+
+    def save(self, path, **extra):
+        """ Writes the index, and any extra arrays, to a .npz file """
+        np.savez(path, ids=self.ids, vectors=self.vectors, planes=self.planes,
+                 params=np.array([self.dim, self.tables, self.bits, self.seed]), **extra)
+
+    @classmethod
+    def load(cls, path):
+        """ Reads an index written by save """
+        data = np.load(path)
+        dim, tables, bits, seed = [int(value) for value in data['params']]
+        index = cls(dim, tables, bits, seed)
+        index.planes = data['planes']
+        return index.build(data['ids'], data['vectors'])
+
+
+class CrossSellIndex(object):
+    """ Finds the products most similar to a product for cross-sell recommendations """
+
+    def __init__(self, encoder=None, index=None):
+        self.encoder = encoder
+        self.index = index
+
+    def build(self, products, attributes=(), tables=8, bits=12, seed=0):
+        """ Fits the encoder to the catalog and indexes every product by id """
+        products = [_toDict(product) for product in products]
+        self.encoder = FeatureEncoder(attributes).fit(products)
+        self.index = LSHIndex(self.encoder.dim, tables, bits, seed)
+        self.index.build([product['id'] for product in products], self.encoder.encodeMany(products))
+        return self
+
+    def query(self, product, k, probes=1):
+        """ Returns up to k (product id, similarity) cross-sell candidates for a product dict or JSON string """
+        product = _toDict(product)
+        return self.index.query(self.encoder.encode(product), k, probes, exclude=product.get('id'))
+
+    def save(self, path):
+        """ Writes the index and the fitted encoder to a .npz file """
+        self.index.save(path, encoder=np.array(json.dumps(self.encoder.toDict())))
+
+    @classmethod
+    def load(cls, path):
+        """ Reads an index written by save """
+        encoder = FeatureEncoder.fromDict(json.loads(str(np.load(path)['encoder'])))
+        return cls(encoder, LSHIndex.load(path))
+
+
+def bruteForce(ids, vectors, vector, k, exclude=None):
+    """ Returns the exact k most similar (product id, cosine similarity) tuples """
+    ids = np.asarray(ids)
+    similarities = np.dot(vectors, np.asarray(vector, dtype=np.float32))
+    if exclude is not None:
+        similarities = np.where(ids == exclude, -np.inf, similarities)
+    best = np.argsort(-similarities, kind='mergesort')[:k]
+    return [(ids[i].item(), float(similarities[i])) for i in best if np.isfinite(similarities[i])]
+
+
+def recall(approximate, exact):
+    """ Fraction of the exact neighbours that the approximate answer found """
+    if not exact:
+        return 1.0
+    expected = set(product_id for product_id, similarity in exact)
+    return len(expected.intersection(product_id for product_id, similarity in approximate)) / float(len(expected))
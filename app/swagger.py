@@ -13,6 +13,9 @@ api = Api(app,
 # This namespace is the start of the path i.e., /recommendations
 ns = api.namespace('recommendations', description='Recommendation operations')
 
+# The storefront's read path, /products/<product_id>/recommendations
+products_ns = api.namespace('products', description='Recommendations of a product')
+
 rec_type_model = api.model('RecommendationType', {
     'id': fields.Integer(readOnly=True,
                          description='The unique id assigned internally by service'),
@@ -52,4 +55,29 @@ expected_create_model  = api.model('Recommendation', {
     'weight': fields.Float(required=True,
                          description='The calculated weight generated by the Algorithm \
                                         quantifying the quality of the recommendation')
-})
\ No newline at end of file
+})
+
+# One entry of a product's recommendation set, the product and type come from the path
+expected_set_model = api.model('RecommendationSetItem', {
+    'rec_product_id': fields.Integer(required=True,
+                         description='The id of the product that is being recommended'),
+    'weight': fields.Float(required=True,
+                         description='The calculated weight generated by the Algorithm \
+                                        quantifying the quality of the recommendation')
+})
+
+# The products whose recommendations POST /recommendations/lookup returns at once
+expected_lookup_model = api.model('RecommendationLookup', {
+    'product_ids': fields.List(fields.Integer, required=True,
+                         description='The ids of the products to return the recommendations of'),
+    'type': fields.String(required=False,
+                         description='Only return recommendations of this type (i.e. up-sell, accessory)'),
+    'limit': fields.Integer(required=False,
+                         description='The maximum number of recommendations of each product, all of them when not given')
+})
+
+lookup_result_model = api.model('RecommendationLookupResult', {
+    'product_id': fields.Integer(description='The id of a product that was looked up'),
+    'recommendations': fields.List(fields.Nested(recommendation_model),
+                         description='Its recommendations, highest weight first')
+})
@@ -1,8 +1,10 @@
-from server import app
+from server import app, check_rec_type
 from flask import render_template, request
 from flask_api import status    # HTTP Status Codes
-from werkzeug.exceptions import NotFound
-from models import Recommendation, init_db, db, RecommendationType
+from werkzeug.exceptions import NotFound, BadRequest, Conflict
+from sqlalchemy.exc import IntegrityError
+from models import Recommendation, init_db, db, RecommendationType, transaction, DataValidationError
+from cache import response_cache
 
 ######################################################################
 # Views
@@ -47,8 +49,17 @@ def create_recommendations(recommendation_id):
     """ Create Recommendation View """
     data = request.get_json()
     rec = Recommendation()
-    rec.deserialize(data)
-    rec.save()
+    try:
+        rec.deserialize(data)
+    except DataValidationError as error:
+        raise BadRequest(str(error))
+    check_rec_type(rec)
+    try:
+        with transaction():
+            rec.save()
+    except IntegrityError:
+        raise Conflict("The product already has this Recommendation.")
+    response_cache.invalidate(rec.product_id, rec.rec_type_id)
     message = rec.serialize()
 
     return render_template('manage.html', name="Manage", result=message), status.HTTP_201_CREATED
@@ -0,0 +1,134 @@
+"""
+Engine Micro-benchmarks
+
+Times the Engine hot paths on synthetic catalogs and compares the results to
+a JSON baseline, failing when a run regresses beyond a threshold. Runs
+offline, no database is used.
+
+Benchmarks
+----------
+parse        - ParsedProduct.fromMetaData on every candidate (JSON decoding)
+getWeight    - per-pair Engine.getWeight on every candidate, through the metadata cache
+columns      - buildCandidateColumns for the whole candidate set
+batch        - Engine.scoreCandidates on prebuilt columns
+topK         - Engine.getTopCandidates with k=10
+
+Usage:
+    python benchmarks/bench_engine.py                 # compare with the baseline
+    python benchmarks/bench_engine.py --save          # record a new baseline
+    python benchmarks/bench_engine.py --sizes 1000,100000 --threshold 25
+
+Baselines are machine specific, record one on the machine that runs the comparison.
+"""
+import os
+import sys
+import json
+import argparse
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.engine import Engine, MetaDataCache, ParsedProduct, buildCandidateColumns
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'engine_baseline.json')
+SIZES = [1000, 100000, 1000000]
+
+def syntheticCatalog(count, categories=50, seed=0):
+    """ Generates product JSON strings with a random category and a log-normal price """
+    random = np.random.RandomState(seed)
+    category = random.randint(0, categories, count)
+    price = np.round(random.lognormal(3.0, 1.0, count), 2)
+    return ['{"id":%d,"name":"product %d","category":"category-%d","price":"%.2f"}'
+            % (i, i, category[i], price[i]) for i in range(count)]
+
+def _time(function, repeat):
+    """ Best wall time of repeated runs """
+    best = None
+    for _ in range(repeat):
+        started = timeit.default_timer()
+        function()
+        elapsed = timeit.default_timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(sizes, repeat=3):
+    """ Returns {'<benchmark>@<size>': seconds} for every benchmark and size """
+    results = {}
+    for size in sizes:
+        catalog = syntheticCatalog(size)
+        anchor = catalog[0]
+        ids, categories, prices, codes = buildCandidateColumns(catalog, cache=MetaDataCache(maxsize=size))
+
+        def parse():
+            for metadata in catalog:
+                ParsedProduct.fromMetaData(metadata)
+
+        def getWeight():
+            engine = Engine(anchor, 1, cache=MetaDataCache())
+            for metadata in catalog:
+                engine.getWeight(metadata)
+
+        def columns():
+            buildCandidateColumns(catalog, cache=MetaDataCache(maxsize=size))
+
+        def batch():
+            Engine(anchor, 1).scoreCandidates(categories, prices, codes)
+
+        def topK():
+            Engine(anchor, 1, cache=MetaDataCache()).getTopCandidates(catalog, 10)
+
+        for name, function in [('parse', parse), ('getWeight', getWeight), ('columns', columns),
+                               ('batch', batch), ('topK', topK)]:
+            seconds = _time(function, repeat)
+            results['%s@%d' % (name, size)] = seconds
+            print '%-20s %10.4f s %10.1f ns/candidate' % ('%s@%d' % (name, size), seconds, seconds * 1e9 / size)
+            sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    """ Returns the benchmarks that are more than threshold percent slower than the baseline """
+    regressions = []
+    for name, seconds in sorted(results.iteritems()):
+        if name in baseline and seconds > baseline[name] * (1 + threshold / 100.0):
+            regressions.append((name, baseline[name], seconds))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Engine micro-benchmarks')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help='comma separated candidate counts (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best is kept')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='allowed slowdown in percent before failing (default: %(default)s)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline JSON file')
+    parser.add_argument('--save', action='store_true', help='record this run as the baseline')
+    args = parser.parse_args(argv)
+
+    results = run([int(size) for size in args.sizes.split(',')], args.repeat)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print 'Baseline saved to %s' % args.baseline
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print 'No baseline at %s, run with --save to record one' % args.baseline
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.threshold)
+    for name, before, after in regressions:
+        print 'REGRESSION %s: %.4f s -> %.4f s (+%.0f%%)' % (name, before, after, (after / before - 1) * 100)
+    if regressions:
+        return 1
+    print 'No regressions beyond %.0f%%' % args.threshold
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
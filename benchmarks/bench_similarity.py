@@ -0,0 +1,65 @@
+"""
+Cross-sell Similarity Benchmark
+
+Compares the LSH index against exact brute force search on a synthetic
+catalog, reporting recall@k and query latency for several index shapes.
+
+Usage:
+    python benchmarks/bench_similarity.py [--products 100000] [--queries 200] [--k 10]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from app.similarity import FeatureEncoder, LSHIndex, bruteForce, recall
+
+# (tables, bits, probes) shapes to compare
+SHAPES = [(4, 8, 0), (8, 10, 0), (8, 10, 2), (12, 12, 2), (16, 14, 4)]
+
+def syntheticProducts(count, categories=50, colors=12, seed=0):
+    """ Generates product dicts with a category, a log-normal price and a color """
+    random = np.random.RandomState(seed)
+    category = random.randint(0, categories, count)
+    price = np.round(random.lognormal(3.0, 1.0, count), 2)
+    color = random.randint(0, colors, count)
+    return [{'id': i, 'category': 'category-%d' % category[i], 'price': price[i],
+             'color': 'color-%d' % color[i]} for i in range(count)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LSH recall vs latency benchmark')
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    products = syntheticProducts(args.products)
+    encoder = FeatureEncoder(attributes=['color']).fit(products)
+    vectors = encoder.encodeMany(products)
+    ids = np.arange(args.products)
+    queries = np.random.RandomState(1).choice(args.products, args.queries, replace=False)
+
+    started = time.time()
+    exact = [bruteForce(ids, vectors, vectors[i], args.k, exclude=i) for i in queries]
+    brute_ms = (time.time() - started) * 1000.0 / args.queries
+    print '%d products, %d dimensions, %d queries, k=%d' % (args.products, encoder.dim, args.queries, args.k)
+    print '%-22s %10s %10s %10s' % ('index', 'build s', 'recall', 'query ms')
+    print '%-22s %10s %10.3f %10.3f' % ('brute force', '-', 1.0, brute_ms)
+
+    for tables, bits, probes in SHAPES:
+        started = time.time()
+        index = LSHIndex(encoder.dim, tables, bits).build(ids, vectors)
+        build_s = time.time() - started
+
+        started = time.time()
+        results = [index.queryById(i, args.k, probes) for i in queries]
+        query_ms = (time.time() - started) * 1000.0 / args.queries
+        found = np.mean([recall(result, expected) for result, expected in zip(results, exact)])
+        name = 'lsh %dx%d probes=%d' % (tables, bits, probes)
+        print '%-22s %10.2f %10.3f %10.3f' % (name, build_s, found, query_ms)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
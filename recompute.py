@@ -0,0 +1,17 @@
+"""
+Recommendation Recompute Job Runner
+
+Recomputes the recommendation weights of a whole product catalog
+
+Usage:
+    python recompute.py catalog.ndjson [--type up-sell] [--processes 4] [--restart]
+"""
+
+import sys
+from app import recompute
+
+#########################################################################
+#   M A I N
+#########################################################################
+if __name__ == "__main__":
+    sys.exit(recompute.main())
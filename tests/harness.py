@@ -0,0 +1,95 @@
+"""
+Transactional Database Harness for the Test Cases
+
+The schema is created and seeded once per test run instead of with
+drop_all/create_all around every test. Each test then runs in a transaction
+on its own connection, and the session works inside a SAVEPOINT, so the code
+under test can commit and roll back as usual. Everything a test wrote is
+rolled back in tearDown.
+
+Run the suite with APP_SETTING=SQLiteTestingConfig to use an in-memory SQLite
+database instead of Postgres.
+"""
+import os
+import unittest
+from sqlalchemy import event
+from sqlalchemy.pool import reset_none
+from app import app
+from app.models import db, init_db, restart_sequences
+
+APP_SETTING = os.getenv('APP_SETTING', 'TestingConfig')
+
+# Engines whose schema has been created during this run, a test that points
+# the app at another database makes the next test prepare a new engine
+_prepared = set()
+
+def _enable_sqlite_savepoints(engine):
+    """ Lets SQLAlchemy emit BEGIN instead of pysqlite, which otherwise breaks SAVEPOINT """
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
+    # the in-memory database is a single connection shared through the pool,
+    # returning it after create_all() must not roll back the running test
+    engine.pool._reset_on_return = reset_none
+
+def prepare_database():
+    """ Creates and seeds the schema of the configured database once, returns its engine """
+    app.config.from_object('config.%s' % str(APP_SETTING))
+    engine = db.engine
+    if engine not in _prepared:
+        if engine.dialect.name == 'sqlite':
+            _enable_sqlite_savepoints(engine)
+        db.session.remove()
+        db.drop_all()
+        init_db()
+        db.session.remove()
+        _prepared.add(engine)
+    return engine
+
+def is_postgres():
+    """ True when the tests run against Postgres """
+    return prepare_database().dialect.name == 'postgresql'
+
+def _restart_savepoint(session, transaction):
+    """ Opens a new SAVEPOINT whenever the code under test commits or rolls back the test's one """
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+class TransactionalTestCase(unittest.TestCase):
+    """ Runs every test in a transaction that is rolled back afterwards """
+
+    def setUp(self):
+        """ Binds the session to a connection with an open transaction and SAVEPOINT """
+        engine = prepare_database()
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+
+        self.session = db.create_scoped_session(options={'bind': self.connection, 'binds': {}})
+        # Flask removes the session after every request, only forget the loaded
+        # objects so the SAVEPOINT stays open
+        self.session.remove = self.session.expunge_all
+        event.listen(self.session, 'after_transaction_end', _restart_savepoint)
+        self._app_session, db.session = db.session, self.session
+
+        restart_sequences()
+        self.session.begin_nested()
+
+    def tearDown(self):
+        """ Rolls back everything the test wrote """
+        event.remove(self.session, 'after_transaction_end', _restart_savepoint)
+        self.session.close()
+        db.session = self._app_session
+        self.transaction.rollback()
+        self.connection.close()
+
+    def skip_unless_postgres(self, reason):
+        """ Skips a test of a Postgres only feature when running on another database """
+        if self.connection.dialect.name != 'postgresql':
+            self.skipTest(reason)
@@ -0,0 +1,279 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for the Response Cache """
+import unittest
+from mock import patch
+from app.cache import ResponseCache, CacheBackend, MemoryBackend, create_backend, VERSION_TTL
+
+
+class FakeClock(object):
+    """ A clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class BrokenBackend(CacheBackend):
+    """ A backend that cannot be reached """
+
+    def get(self, key):
+        raise IOError('Connection refused')
+
+    set = delete_indexed = get_versions = set_versions = publish = get
+
+    def subscribe(self, channel, callback):
+        return MemoryBackend().subscribe(channel, callback)
+
+
+class DownBackend(BrokenBackend):
+    """ A backend that cannot even be subscribed to """
+
+    subscribe = BrokenBackend.get
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestResponseCache(unittest.TestCase):
+    """ Response Cache Tests """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(maxsize=3, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """ Stored values are returned until they expire """
+        self.assertIsNone(self.cache.get('a'))
+        self.assertTrue(self.cache.set('a', [1], (23, 1)))
+        self.assertEqual(self.cache.get('a'), [1])
+        self.clock.now += 10
+        self.assertIsNone(self.cache.get('a'))
+        info = self.cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['expirations'], info['size']), (1, 2, 1, 0))
+        self.assertAlmostEqual(info['hit_ratio'], 1 / 3.0)
+
+    def test_least_recently_used_is_evicted(self):
+        """ The least recently used entry makes room for a new one """
+        for key in 'abc':
+            self.cache.set(key, key, (None, None))
+        self.cache.get('a')
+        self.cache.set('d', 'd', (None, None))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual([self.cache.get(key) for key in 'acd'], ['a', 'c', 'd'])
+        self.assertEqual(self.cache.info()['evictions'], 1)
+
+    def test_configure_shrinks(self):
+        """ Shrinking the cache evicts the oldest entries """
+        for key in 'abc':
+            self.cache.set(key, key, (None, None))
+        self.cache.configure(1, 5)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get('c'), 'c')
+        self.assertEqual(self.cache.info()['ttl'], 5)
+
+    def test_invalidate_product_and_type(self):
+        """ A write drops only the queries that can include it """
+        self.cache.configure(10, 10)
+        self.cache.set('product 23 up-sell', 1, (23, 1))
+        self.cache.set('product 23', 2, (23, None))
+        self.cache.set('up-sell', 3, (None, 1))
+        self.cache.set('all', 4, (None, None))
+        self.cache.set('product 23 accessory', 5, (23, 2))
+        self.cache.set('product 24 up-sell', 6, (24, 1))
+        self.cache.set('accessory', 7, (None, 2))
+
+        self.assertEqual(self.cache.invalidate(23, 1), 4)
+        for key in ['product 23 up-sell', 'product 23', 'up-sell', 'all']:
+            self.assertIsNone(self.cache.get(key))
+        self.assertEqual([self.cache.get(key) for key in ['product 23 accessory', 'product 24 up-sell', 'accessory']],
+                         [5, 6, 7])
+        self.assertEqual(self.cache.info()['invalidations'], 4)
+
+    def test_invalidate_type(self):
+        """ Activating or deactivating a type drops its queries for every product """
+        self.cache.configure(10, 10)
+        self.cache.set('product 23 up-sell', 1, (23, 1))
+        self.cache.set('product 24 up-sell', 2, (24, 1))
+        self.cache.set('product 24', 3, (24, None))
+        self.cache.set('product 24 accessory', 4, (24, 2))
+        self.assertEqual(self.cache.invalidate_type(1), 3)
+        self.assertEqual(self.cache.get('product 24 accessory'), 4)
+
+    def test_stale_set_is_refused(self):
+        """ A value read before an invalidation is not stored after it """
+        version = self.cache.version()
+        self.cache.invalidate(23, 1)
+        self.assertFalse(self.cache.set('product 23', 1, (23, None), version))
+        self.assertIsNone(self.cache.get('product 23'))
+        self.assertTrue(self.cache.set('product 23', 1, (23, None), self.cache.version()))
+
+    def test_no_etag_without_backend(self):
+        """ A cache local to this process cannot see the writes of the others, so it has no entity tags """
+        self.assertIsNone(self.cache.etag(23, 1))
+        self.cache.invalidate(23, 1)
+        self.assertIsNone(self.cache.etag(23, 1))
+
+    def test_invalidate_many(self):
+        """ Several products and types are invalidated at once """
+        self.cache.set('product 23', 1, (23, None))
+        self.cache.set('product 24', 2, (24, None))
+        self.cache.set('product 25', 3, (25, None))
+        self.assertEqual(self.cache.invalidate_many([(23, 1), (24, 2)]), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_clear(self):
+        """ Clearing removes every entry and resets the counters """
+        self.cache.set('a', 1, (None, None))
+        self.cache.get('a')
+        self.cache.clear()
+        self.assertEqual(self.cache.info()['hits'], 0)
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestSharedResponseCache(unittest.TestCase):
+    """ Two instances whose caches share one backend """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = MemoryBackend(clock=self.clock)
+        self.first = ResponseCache(maxsize=10, ttl=10, clock=self.clock)
+        self.second = ResponseCache(maxsize=10, ttl=10, clock=self.clock)
+        self.first.attach(self.backend)
+        self.second.attach(self.backend)
+
+    def test_miss_is_served_from_shared_store(self):
+        """ A page cached by one instance is found by the other """
+        self.first.set('a', [1], (23, 1))
+        self.assertEqual(self.second.get('a'), [1])
+        self.assertEqual(self.second.get('a'), [1])
+        info = self.second.info()
+        self.assertEqual((info['hits'], info['misses'], info['shared_hits']), (1, 1, 1))
+        self.assertTrue(info['shared'])
+
+    def test_shared_entries_expire(self):
+        """ The shared store forgets pages after the time to live """
+        self.first.set('a', [1], (23, 1))
+        self.clock.now += 10
+        self.assertIsNone(self.second.get('a'))
+
+    def test_invalidation_reaches_other_instances(self):
+        """ A write on one instance evicts the pages the other keeps """
+        self.first.set('product 23', 1, (23, None))
+        self.first.set('product 24', 2, (24, None))
+        self.second.get('product 23')
+        self.second.get('product 24')
+
+        self.first.invalidate(23, 1)
+        self.assertEqual(len(self.second), 1)
+        self.assertIsNone(self.second.get('product 23'))
+        self.assertIsNone(self.backend.get('recommendations:page:"product 23"'))
+        self.assertEqual(self.second.get('product 24'), 2)
+        self.assertEqual(self.second.info()['remote_invalidations'], 1)
+
+    def test_type_invalidation_and_clear_reach_other_instances(self):
+        """ Activating a type or resetting on one instance empties the other """
+        self.first.set('up-sell', 1, (None, 1))
+        self.first.set('accessory', 2, (None, 2))
+        self.second.get('up-sell')
+        self.second.get('accessory')
+        self.first.invalidate_type(1)
+        self.assertEqual(len(self.second), 1)
+        self.first.clear()
+        self.assertEqual(len(self.second), 0)
+        self.assertIsNone(self.second.get('accessory'))
+
+    def test_remote_invalidation_refuses_stale_set(self):
+        """ A page read before another instance's write is not cached """
+        version = self.second.version()
+        self.first.invalidate(23, 1)
+        self.assertFalse(self.second.set('product 23', 1, (23, None), version))
+
+    def test_etag_changes_with_the_query_writes(self):
+        """ The entity tag of a query changes only with the writes that can change it """
+        etag = self.first.etag(23, 1)
+        self.first.invalidate(24, 1)
+        self.first.invalidate(23, 2)
+        self.assertEqual(self.first.etag(23, 1), etag)
+        self.assertNotEqual(self.first.etag(23, None), etag)
+        self.first.invalidate(23, 1)
+        self.assertNotEqual(self.first.etag(23, 1), etag)
+        etag = self.first.etag(23, 1)
+        self.first.invalidate_type(2)
+        self.assertNotEqual(self.first.etag(23, 1), etag)
+
+    def test_etag_survives_expired_versions(self):
+        """ An expired version token is replaced, the tags handed out before stop matching """
+        etag = self.first.etag(23, 1)
+        self.clock.now += VERSION_TTL - 1
+        self.assertEqual(self.second.etag(23, 1), etag)
+        self.clock.now += 1
+        self.assertNotEqual(self.second.etag(23, 1), etag)
+        self.assertEqual(self.first.etag(23, 1), self.second.etag(23, 1))
+
+    def test_instances_share_etags(self):
+        """ Both instances hand out the same entity tag and see each other's writes """
+        etag = self.first.etag(23, 1)
+        self.assertEqual(self.second.etag(23, 1), etag)
+        self.second.invalidate_many([(23, 1), (24, 1)])
+        self.assertNotEqual(self.first.etag(23, 1), etag)
+        self.assertEqual(self.first.etag(23, 1), self.second.etag(23, 1))
+
+    def test_detached_cache_is_local(self):
+        """ After detaching, invalidations of the other instances no longer arrive """
+        self.second.set('a', 1, (23, 1))
+        self.second.detach()
+        self.first.invalidate(23, 1)
+        self.assertEqual(self.second.get('a'), 1)
+        self.assertFalse(self.second.info()['shared'])
+
+    def test_unreachable_backend(self):
+        """ Without its backend the cache keeps working on local entries """
+        cache = ResponseCache(maxsize=10, ttl=10, clock=self.clock)
+        cache.attach(BrokenBackend())
+        self.assertIsNone(cache.get('a'))
+        self.assertTrue(cache.set('a', 1, (23, 1)))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.invalidate(23, 1), 1)
+        self.assertIsNone(cache.etag(23, 1))
+
+    def test_unsubscribable_backend(self):
+        """ A backend that refuses the subscription leaves the cache local, retried with a backoff """
+        cache = ResponseCache(maxsize=10, ttl=10, clock=self.clock)
+        self.assertFalse(cache.attach(DownBackend()))
+        self.assertFalse(cache.info()['shared'])
+        self.assertTrue(cache.set('a', 1, (23, 1)))
+        self.assertEqual(cache.get('a'), 1)
+
+        with patch('app.cache.create_backend', side_effect=lambda url: DownBackend()) as create:
+            cache.connect('redis://down')
+            cache.connect('redis://down')
+            self.assertEqual(create.call_count, 1)
+            self.clock.now += 1
+            cache.connect('redis://down')
+            self.assertEqual(create.call_count, 2)
+            # the delay doubled after the second failure
+            self.clock.now += 1
+            cache.connect('redis://down')
+            self.assertEqual(create.call_count, 2)
+            create.side_effect = lambda url: MemoryBackend(clock=self.clock)
+            self.clock.now += 1
+            cache.connect('redis://down')
+            self.assertTrue(cache.info()['shared'])
+            cache.connect('redis://down')
+            self.assertEqual(create.call_count, 3)
+
+    def test_create_backend(self):
+        """ Backends are chosen by the scheme of their URL """
+        self.assertIsInstance(create_backend('memory://'), MemoryBackend)
+        self.assertRaises(ValueError, create_backend, 'memcached://localhost')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
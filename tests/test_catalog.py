@@ -0,0 +1,62 @@
+import unittest
+from mock import patch
+from app.catalog import CatalogIndex
+from app.engine import Engine, ParsedProduct, SCORER_RULES
+
+class CatalogIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.socks = '{"id":"1","name":"socks","category":"footwear","price":"4.50"}'
+        self.catalog = CatalogIndex([
+            self.socks,
+            '{"id":"2","name":"shoes","category":"footwear","price":"8.50"}',
+            '{"id":"3","name":"cheapsocks","category":"footwear","price":"1.50"}',
+            '{"id":"4","name":"flipflops","category":"swimwear","price":"8.50"}',
+            '{"id":"5","name":"broccoli","category":"vegetables","price":".50"}',
+            '{"id":"6","name":"towel","category":"swimwear","price":"4.50"}'])
+
+    def tearDown(self):
+        self.catalog = None
+
+    def test_productsInCategory(self):
+        """Testing Category Lookups"""
+        self.assertEquals(self.catalog.productsInCategory("footwear"), ["3", "1", "2"])
+        self.assertEquals(self.catalog.productsInCategory("toys"), [])
+
+    def test_productsPricedAbove(self):
+        """Testing Price Range Lookups"""
+        self.assertEquals(self.catalog.productsPricedAbove(4.5), ["2", "4"])
+        self.assertEquals(self.catalog.productsPricedAbove(1.0, "footwear"), ["3", "1", "2"])
+        self.assertEquals(self.catalog.productsPricedAbove(1.0, "toys"), [])
+        self.assertEquals(self.catalog.productsPricedBetween(1.5, 4.5), ["3", "1", "6"])
+
+    def test_getUpsellCandidates(self):
+        """Testing Up-sell Candidates match the Engine weights"""
+        candidates = dict(self.catalog.getUpsellCandidates(self.socks))
+        self.assertEquals(candidates, {"2": 2, "3": 1, "4": 1})
+
+        engine = Engine(self.socks, 1)
+        for product in self.catalog.products.values():
+            if product.id != "1":
+                metadata = '{"id":"%s","category":"%s","price":"%s"}' % (product.id, product.category, product.price)
+                self.assertEquals(candidates.get(product.id, 0), engine.getWeight(metadata))
+
+    def test_getUpsellCandidatesFollowRules(self):
+        """Testing Up-sell Candidate weights come from the up-sell rule"""
+        rule = dict(SCORER_RULES['up-sell'], same_category=3, price_weight=5)
+        with patch.dict(SCORER_RULES, {'up-sell': rule}):
+            candidates = dict(self.catalog.getUpsellCandidates(self.socks))
+        self.assertEquals(candidates, {"2": 8, "3": 3, "4": 5})
+
+    def test_addAndRemove(self):
+        """Testing Adding and Removing Products"""
+        self.catalog.add(ParsedProduct("3", "swimwear", 9.0))
+        self.assertEquals(self.catalog.productsInCategory("footwear"), ["1", "2"])
+        self.assertEquals(self.catalog.productsPricedAbove(8.5), ["3"])
+        self.assertEquals(self.catalog.remove("5").category, "vegetables")
+        self.assertEquals(self.catalog.remove("5"), None)
+        self.assertFalse("vegetables" in self.catalog.by_category)
+        self.assertEquals(len(self.catalog), 5)
+        self.assertTrue("3" in self.catalog)
+
+if __name__ == '__main__':
+    unittest.main()
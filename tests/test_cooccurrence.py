@@ -0,0 +1,65 @@
+""" Test cases for Co-occurrence Ingestion """
+import os
+import shutil
+import tempfile
+import unittest
+from app.cooccurrence import CooccurrenceIngester, CountMinSketch, TopCandidates, basketPairs, readBaskets
+
+class CooccurrenceTestCase(unittest.TestCase):
+    """ Co-occurrence Ingestion Tests """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.log = os.path.join(self.folder, 'orders.ndjson')
+        with open(self.log, 'w') as log:
+            log.write('{"order_id": 1, "products": [1, 2, 3]}\n')
+            log.write('{"order_id": 2, "products": [1, 2]}\n')
+            log.write('\n')
+            log.write('not json\n')
+            log.write('{"order_id": 3, "items": [1, 2, 2]}\n')
+            log.write('{"order_id": 4, "products": [3, 4]}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_read_baskets(self):
+        """ Read baskets from an order log """
+        self.assertEqual(list(readBaskets(self.log)), [[1, 2, 3], [1, 2], [1, 2, 2], [3, 4]])
+
+    def test_basket_pairs(self):
+        """ Pair every product of a basket """
+        self.assertEqual(sorted(basketPairs([1, 2, 2, 3])),
+                         [(1, 2), (1, 3), (2, 1), (2, 3), (3, 1), (3, 2)])
+
+    def test_count_min_sketch(self):
+        """ Count-min sketch estimates """
+        sketch = CountMinSketch(width=64, depth=3)
+        for i in range(10):
+            sketch.add((1, 2))
+        self.assertEqual(sketch.add((1, 2), 5), 15)
+        self.assertTrue(sketch.estimate((2, 1)) >= 0)
+        self.assertEqual(sketch.table.shape, (3, 64))
+
+    def test_top_candidates(self):
+        """ Top candidates stay bounded """
+        top = TopCandidates(2)
+        top.offer('a', 1)
+        top.offer('b', 3)
+        top.offer('c', 1)
+        top.offer('d', 2)
+        top.offer('b', 4)
+        self.assertEqual(top.counts, {'b': 4, 'd': 2})
+
+    def test_recommendations(self):
+        """ Emit normalized recommendations """
+        ingester = CooccurrenceIngester(width=1024, depth=4, top=5).ingest(readBaskets(self.log))
+        self.assertEqual(ingester.baskets, 4)
+        recs = list(ingester.recommendations(2))
+        pairs = sorted((rec.product_id, rec.rec_product_id, rec.weight) for rec in recs)
+        self.assertEqual(pairs, [(1, 2, 1.0), (2, 1, 1.0)])
+        self.assertEqual(recs[0].rec_type_id, 2)
+        recs = list(ingester.recommendations(2, min_count=1))
+        self.assertTrue((3, 4, 0.5) in [(rec.product_id, rec.rec_product_id, rec.weight) for rec in recs])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 import unittest
-from app.engine import Engine
+import numpy as np
+from mock import patch
+from app.engine import Engine, MetaDataCache, ParsedProduct, ScorerRegistry, SCORER_RULES, buildCandidateColumns
 
 class EngineTestCase(unittest.TestCase):
     def setUp(self):
@@ -17,20 +19,18 @@ class EngineTestCase(unittest.TestCase):
 
     def test_parseMetaData(self):
         """Testing Parsing of Product Metadata"""
-        #getting valid product metadata
-        p1, p2 = self.rec_engine_1.parseMetaData(self.other_prod_1)
-        #valid product_1_metadata
-        self.assertEquals(p1,{"id":"1","name":"socks","category":"footwear","price":"4.50"})
-        #valid product_2_metadata
-        self.assertEquals(p2,{"id":"2","name":"shoes","category":"footwear","price":"8.50"})
+        product = ParsedProduct.fromMetaData(self.other_prod_1)
+        self.assertEquals((product.id, product.category, product.price), ("2", "footwear", 8.5))
 
     def test_nothingToParse(self):
         """Testing Nothing to Parse"""
-        self.assertEquals(self.rec_engine_1.parseMetaData(""), "Missing metadata for one or both products!" )
+        self.assertEquals(self.rec_engine_1.getWeight(""), "Missing metadata for one or both products!" )
 
     def test_parsingInvalidJSON(self):
         """Testing Parsing Invalid JSON"""
-        self.assertRaises(Exception, self.rec_engine_1.parseMetaData('"id":"1","name":"socks","adf":"footwear"4.50"}'))
+        self.assertRaises(ValueError, ParsedProduct.fromMetaData, '"id":"1","name":"socks","adf":"footwear"4.50"}')
+        self.assertEquals(self.rec_engine_1.getWeight('"id":"1","name":"socks","adf":"footwear"4.50"}'),
+                          "Invalid metadata! Confirm you entered an id, category, and price. Also, confirm that price is a numeric value!")
 
     def test_badRecType(self):
         """Testing Bad Recommendation Types"""
@@ -48,5 +48,120 @@ class EngineTestCase(unittest.TestCase):
         self.assertEquals(self.rec_engine_1.getWeight(self.other_prod_3),1)
         self.assertEquals(self.rec_engine_1.getWeight(self.other_prod_4),0)
 
+    def test_scoreCandidates(self):
+        """Testing Batch Weights match the per-pair Weights"""
+        others = [self.other_prod_1, self.other_prod_2, self.other_prod_3, self.other_prod_4]
+        ids, categories, prices, codes = buildCandidateColumns(others)
+        self.assertEquals(ids, ["2", "4", "3", "2"])
+        weights = self.rec_engine_1.scoreCandidates(categories, prices, codes)
+        self.assertEquals(list(weights), [self.rec_engine_1.getWeight(other) for other in others])
+
+    def test_scoreCandidatesByName(self):
+        """Testing Batch Weights with category names"""
+        categories = np.array(["footwear", "swimwear", "footwear", "vegetables"])
+        prices = np.array([8.5, 8.5, 1.5, .5])
+        self.assertEquals(list(self.rec_engine_1.scoreCandidates(categories, prices)), [2, 1, 1, 0])
+
+    def test_scoreCandidatesUnknownCategory(self):
+        """Testing Batch Weights when the anchor category has no code"""
+        weights = self.rec_engine_1.scoreCandidates([0, 1], [8.5, 1.5], {"food": 0, "toys": 1})
+        self.assertEquals(list(weights), [1, 0])
+
+    def test_scoreCandidatesCodesWithoutNames(self):
+        """Testing Batch Weights with category codes but no category_codes dict"""
+        weights = self.rec_engine_1.scoreCandidates(np.array([0, 1]), [8.5, 1.5])
+        self.assertEquals(list(weights), [1, 0])
+
+    def test_scoreCandidatesEmpty(self):
+        """Testing Batch Weights without candidates"""
+        weights = self.rec_engine_1.scoreCandidates([], [])
+        self.assertEquals(len(weights), 0)
+
+    def test_scoreCandidatesBadInput(self):
+        """Testing Batch Weights with bad input"""
+        self.assertEquals(self.rec_engine_2.scoreCandidates(["food"], [1.0]), "Invalid rec_type_id")
+        self.assertEquals(self.rec_engine_1.scoreCandidates(["food"], ["somethingwrong"]),"Invalid metadata! Confirm you entered an id, category, and price. Also, confirm that price is a numeric value!")
+
+    def test_parsedProduct(self):
+        """Testing Parsed Product Records"""
+        product = ParsedProduct.fromMetaData(self.other_prod_1)
+        self.assertEquals((product.id, product.category, product.price), ("2", "footwear", 8.5))
+        self.assertRaises(AttributeError, setattr, product, "name", "shoes")
+        self.assertRaises(ValueError, ParsedProduct.fromMetaData, self.other_prod_5)
+
+    def test_metadataCache(self):
+        """Testing Metadata Cache Hits and Misses"""
+        cache = MetaDataCache(maxsize=2)
+        engine = Engine('{"id":"1","name":"socks","category":"footwear","price":"4.50"}', 1, cache)
+        self.assertEquals(engine.getWeight(self.other_prod_1), 2)
+        self.assertEquals(engine.getWeight(self.other_prod_1), 2)
+        self.assertEquals(engine.getWeight(self.other_prod_3), 1)
+        info = cache.info()
+        self.assertEquals(info["hits"], 1)
+        self.assertEquals(info["misses"], 3)
+        self.assertEquals(info["size"], 2)
+        #the anchor was evicted but the engine keeps its own parsed copy
+        self.assertEquals(engine.getWeight(self.other_prod_3), 1)
+        self.assertEquals(cache.info()["hits"], 2)
+        cache.clear()
+        self.assertEquals(cache.info(), {"hits": 0, "misses": 0, "size": 0, "maxsize": 2})
+
+    def test_metadataCacheEviction(self):
+        """Testing Least Recently Used Eviction"""
+        cache = MetaDataCache(maxsize=2)
+        cache.get(self.other_prod_1)
+        cache.get(self.other_prod_2)
+        cache.get(self.other_prod_1)
+        cache.get(self.other_prod_3)
+        cache.get(self.other_prod_1)
+        self.assertEquals(cache.hits, 2)
+        cache.get(self.other_prod_2)
+        self.assertEquals(cache.misses, 4)
+
+    def test_getTopCandidates(self):
+        """Testing Top K Candidates"""
+        others = [self.other_prod_4, self.other_prod_2, self.other_prod_3, self.other_prod_1]
+        self.assertEquals(self.rec_engine_1.getTopCandidates(iter(others), 2), [("2", 2), ("3", 1)])
+        self.assertEquals(self.rec_engine_1.getTopCandidates(others, 10), [("2", 2), ("3", 1), ("4", 1), ("2", 0)])
+        self.assertEquals(self.rec_engine_1.getTopCandidates(others, 0), [])
+
+    def test_getTopCandidatesTies(self):
+        """Testing Top K Candidates Tie Breaking"""
+        others = ['{"id":%d,"category":"footwear","price":"9"}' % i for i in range(20, 0, -1)]
+        self.assertEquals(self.rec_engine_1.getTopCandidates(others, 3), [(1, 2), (2, 2), (3, 2)])
+
+    def test_getTopCandidatesBadInput(self):
+        """Testing Top K Candidates with bad input"""
+        others = [self.other_prod_5, "", self.other_prod_2]
+        self.assertEquals(self.rec_engine_1.getTopCandidates(others, 2), [("4", 1)])
+        self.assertEquals(self.rec_engine_2.getTopCandidates(others, 2), "Invalid rec_type_id")
+
+    def test_scorerRegistry(self):
+        """Testing Scorer Registry Dispatch"""
+        registry = ScorerRegistry([(7, "up-sell"), (8, "accessory"), (9, "unknown")])
+        self.assertEquals(registry.get(7).name, "up-sell")
+        self.assertEquals(registry.get(8), None)
+        self.assertEquals(registry.get(9), None)
+        self.assertFalse(1 in registry)
+        engine = Engine('{"id":"1","name":"socks","category":"footwear","price":"4.50"}', 7, registry=registry)
+        self.assertEquals(engine.getWeight(self.other_prod_1), 2)
+
+    def test_typesWithoutRules(self):
+        """Testing that accessory and cross-sell are not scored by rules"""
+        for rec_type_id in (2, 3):
+            engine = Engine('{"id":"1","name":"shoes","category":"footwear","price":"8.50"}', rec_type_id)
+            self.assertEquals(engine.getWeight(self.other_prod_1), "Invalid rec_type_id")
+
+    def test_lowerPriceRule(self):
+        """Testing a Rule for cheaper products of other categories"""
+        rule = {'same_category': 0, 'other_category': 1, 'price': 'lower', 'price_weight': 1}
+        with patch.dict(SCORER_RULES, {'cheaper': rule}):
+            registry = ScorerRegistry([(7, "cheaper")])
+        engine = Engine('{"id":"1","name":"shoes","category":"footwear","price":"8.50"}', 7, registry=registry)
+        others = [self.other_prod_1, self.other_prod_2, self.other_prod_3, self.other_prod_4]
+        self.assertEquals([engine.getWeight(other) for other in others], [0, 1, 1, 2])
+        ids, categories, prices, codes = buildCandidateColumns(others)
+        self.assertEquals(list(engine.scoreCandidates(categories, prices, codes)), [0, 1, 1, 2])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,79 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Query plan tests for the Recommendation read path """
+import unittest
+from sqlalchemy import event
+from app.models import db, Recommendation, RecommendationType
+from harness import is_postgres
+
+# Enough rows that the planner prefers an index over a sequential scan
+ROW_COUNT = 20000
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQueryPlans(unittest.TestCase):
+    """ EXPLAIN the hot finders against a seeded database """
+
+    @classmethod
+    def setUpClass(cls):
+        if not is_postgres():
+            raise unittest.SkipTest('EXPLAIN output is Postgres specific')
+        rows = [{'product_id': i // 20, 'rec_type_id': i % 2 + 1,
+                 'rec_product_id': i, 'weight': (i % 97) / 97.0} for i in range(ROW_COUNT)]
+        db.session.execute(Recommendation.__table__.insert(), rows)
+        db.session.commit()
+        db.session.execute('ANALYZE recommendation')
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        # the rows were committed for EXPLAIN to see them, remove them for the other tests
+        Recommendation.remove_all()
+        db.session.commit()
+        db.session.remove()
+
+    def explain(self, finder, *args):
+        """ Runs a finder and returns the plan of the SQL it sent """
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            finder(*args)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        statement, parameters = statements[0]
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        finally:
+            connection.close()
+
+    def assertIndexScan(self, plan):
+        self.assertIn('ix_recommendation_product_type_weight', plan)
+        self.assertNotIn('Seq Scan on recommendation ', plan + ' ')
+
+    def test_find_by_product_id_uses_index(self):
+        """ find_by_product_id uses the read path index """
+        self.assertIndexScan(self.explain(Recommendation.find_by_product_id, 42))
+
+    def test_find_by_product_id_and_type_uses_index(self):
+        """ find_by_product_id_and_type uses the read path index """
+        rec_type = RecommendationType.find_by_id(1)
+        self.assertIndexScan(self.explain(Recommendation.find_by_product_id_and_type, 42, rec_type))
+
+    def test_find_top_reads_in_index_order(self):
+        """ find_top reads the best rows from the read path index without sorting """
+        rec_type = RecommendationType.find_by_id(1)
+        plan = self.explain(Recommendation.find_top, 42, rec_type, 5)
+        self.assertIndexScan(plan)
+        self.assertNotIn('Sort', plan)
+
+if __name__ == '__main__':
+    unittest.main()
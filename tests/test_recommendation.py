@@ -14,7 +14,11 @@ from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
 
 from app import app
-from app.models import db, DataValidationError, seed_db, init_db
+from app.models import db, DataValidationError, seed_db, init_db, transaction, ROW_CONFLICT, ROW_INVALID
+from app.models import upgrade_schema
+from harness import TransactionalTestCase
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
 
 APP_SETTING = os.getenv('APP_SETTING', 'TestingConfig')
 
@@ -31,25 +35,9 @@ VCAP_SERVICES = {
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
-class TestRecommendations(unittest.TestCase):
+class TestRecommendations(TransactionalTestCase):
     """ Test Cases for Recommendations """
 
-    def setUp(self):
-        """ Creates a new database for the unit test to use """
-
-        app.config.from_object('config.%s' % str(APP_SETTING))
-        db.drop_all()
-        db.create_all()
-        seed_db()
-
-    def tearDown(self):
-        """ Ensures that the database is emptied for next unit test """
-        try:
-            db.session.remove()
-            db.drop_all()
-        except Exception as e:
-            pass
-
     def test_create_a_recommendation(self):
         """ Create a recommendation and assert that it exists """
         data = { "product_id": 54, "rec_type_id": 1, "rec_product_id": 45, "weight": .5 }
@@ -91,6 +79,67 @@ class TestRecommendations(unittest.TestCase):
         rec.delete()
         self.assertEqual(Recommendation.count(), 0)
 
+    def test_save_many_in_a_transaction(self):
+        """ Save many Recommendations in one unit of work """
+        with patch.object(db.session, 'commit', wraps=db.session.commit) as commit_mock:
+            with transaction():
+                for rec_product_id in range(40, 45):
+                    Recommendation(product_id=54, rec_type_id=1, rec_product_id=rec_product_id, weight=.5).save()
+                # nested blocks join the outer unit of work
+                with transaction():
+                    Recommendation(product_id=55, rec_type_id=1, rec_product_id=40, weight=.5).save()
+                self.assertEqual(commit_mock.call_count, 0)
+            self.assertEqual(commit_mock.call_count, 1)
+        self.assertEqual(Recommendation.count(), 6)
+
+    def test_transaction_rolls_back_on_error(self):
+        """ An error in a unit of work discards all of it and is raised """
+        def save_and_fail():
+            with transaction():
+                Recommendation(product_id=54, rec_type_id=1, rec_product_id=40, weight=.5).save()
+                raise DataValidationError('stop')
+        self.assertRaises(DataValidationError, save_and_fail)
+        self.assertEqual(Recommendation.count(), 0)
+
+    def test_save_raises_integrity_error(self):
+        """ Saving a duplicate Recommendation raises instead of failing silently """
+        Recommendation(product_id=54, rec_type_id=1, rec_product_id=45, weight=.5).save()
+        duplicate = Recommendation(product_id=54, rec_type_id=1, rec_product_id=45, weight=.7)
+        self.assertRaises(IntegrityError, duplicate.save)
+        self.assertEqual(Recommendation.count(), 1)
+
+    def test_unique_recommendation(self):
+        """ A product can only recommend another product once per type """
+        constraints = [c.name for c in Recommendation.__table__.constraints]
+        self.assertIn('uq_recommendation_product_type_rec_product', constraints)
+
+        table = Recommendation.__table__
+        row = {'product_id': 54, 'rec_type_id': 1, 'rec_product_id': 45, 'weight': .5}
+        with transaction():
+            db.session.execute(table.insert(), [row, dict(row, rec_type_id=2), dict(row, rec_product_id=46)])
+        with self.assertRaises(IntegrityError):
+            with transaction():
+                db.session.execute(table.insert(), dict(row, weight=.7))
+        self.assertEqual(Recommendation.count(), 3)
+
+    def test_bulk_insert_reports_refused_rows(self):
+        """ Bulk insert reports the rows the database refused without its message """
+        self.skip_unless_postgres('SQLite stores integers of any size')
+        rows = [(0, {'product_id': 54, 'rec_type_id': 1, 'rec_product_id': 45, 'weight': .5}),
+                (1, {'product_id': 2 ** 31, 'rec_type_id': 1, 'rec_product_id': 45, 'weight': .5}),
+                (2, {'product_id': 54, 'rec_type_id': 1, 'rec_product_id': 45, 'weight': .7})]
+        with transaction():
+            errors = Recommendation.bulk_insert(rows)
+        self.assertEqual(errors, [{'index': 1, 'errors': ROW_INVALID},
+                                  {'index': 2, 'errors': ROW_CONFLICT}])
+        self.assertEqual(len(Recommendation.find_by_product_id(54)), 1)
+
+    def test_deserialize_out_of_range(self):
+        """ Deserialize a Recommendation with an id too large for the database """
+        rec = Recommendation()
+        data = { "product_id": 2 ** 31, "rec_type_id": 1, "rec_product_id": 45, "weight": .5 }
+        self.assertRaises(DataValidationError, rec.deserialize, data)
+
     def test_serialize_a_recommendation(self):
         """ Test serialization of a Recommendation """
 
@@ -235,6 +284,45 @@ class TestRecommendations(unittest.TestCase):
         self.assertEqual(rec.rec_product_id, 51)
         self.assertEqual(rec.weight, .5)
 
+    def test_finding_recommendations_by_product_ids(self):
+        """ Find the best Recommendations of many products at once """
+        for product_id, rec_type_id, rec_product_id, weight in [(23, 1, 45, .5), (23, 1, 46, .9), (23, 2, 47, .7),
+                                                                (87, 1, 51, .2), (99, 1, 52, .8)]:
+            Recommendation(product_id=product_id, rec_type_id=rec_type_id,
+                           rec_product_id=rec_product_id, weight=weight).save()
+
+        recs = Recommendation.find_by_product_ids([23, 87, 11])
+        self.assertEqual(sorted(recs), [23, 87])
+        self.assertEqual([rec.rec_product_id for rec in recs[23]], [46, 47, 45])
+
+        recs = Recommendation.find_by_product_ids([23, 87], limit=2)
+        self.assertEqual([rec.rec_product_id for rec in recs[23]], [46, 47])
+        self.assertEqual([rec.rec_product_id for rec in recs[87]], [51])
+
+        recs = Recommendation.find_by_product_ids([23], RecommendationType.find_by_id(2), limit=2)
+        self.assertEqual([rec.rec_product_id for rec in recs[23]], [47])
+
+    def test_find_top_recommendations(self):
+        """ Find the best Recommendations of a product """
+        for rec_type_id, rec_product_id, weight in [(1, 45, .5), (1, 46, .9), (2, 47, .7), (1, 48, .5), (1, 49, .1)]:
+            Recommendation(product_id=23, rec_type_id=rec_type_id,
+                           rec_product_id=rec_product_id, weight=weight).save()
+
+        recs = Recommendation.find_top(23, limit=3)
+        self.assertEqual([rec.rec_product_id for rec in recs], [46, 47, 45])
+        up_sell = RecommendationType.find_by_id(1)
+        recs = Recommendation.find_top(23, up_sell, limit=10, min_weight=.5)
+        self.assertEqual([rec.rec_product_id for rec in recs], [46, 45, 48])
+        self.assertEqual(Recommendation.find_top(24), [])
+
+    def test_validate_lookup(self):
+        """ A lookup needs a list of integer product ids """
+        self.assertEqual(Recommendation.validate_lookup({'product_ids': [3, 1, 3]}), ([3, 1], None, None))
+        self.assertEqual(Recommendation.validate_lookup({'product_ids': [1], 'type': 'up-sell', 'limit': 5}),
+                         ([1], 'up-sell', 5))
+        for data in [None, [1, 2], {'product_ids': []}, {'product_ids': ['a']}, {'product_ids': [1], 'limit': 0}]:
+            self.assertRaises(DataValidationError, Recommendation.validate_lookup, data)
+
     def test_find_with_no_recommendation_data(self):
         """ Find a Recommendation with no Recommendations """
         rec = Recommendation.find_by_id(1)
@@ -284,6 +372,33 @@ class TestRecommendations(unittest.TestCase):
         rec = Recommendation()
         self.assertRaises(DataValidationError, rec.deserialize, data)
 
+class TestSchemaUpgrade(unittest.TestCase):
+    """ Upgrading a recommendation table created before its constraint and index """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE recommendation_type (id INTEGER PRIMARY KEY, created DATETIME, '
+                            'updated DATETIME, name VARCHAR(63), is_active BOOLEAN, product_query VARCHAR(255))')
+        self.engine.execute('CREATE TABLE recommendation (id INTEGER PRIMARY KEY, created DATETIME, '
+                            'updated DATETIME, product_id INTEGER, rec_type_id INTEGER, '
+                            'rec_product_id INTEGER, weight FLOAT)')
+        self.engine.execute(Recommendation.__table__.insert(),
+                            [{'id': 1, 'product_id': 23, 'rec_type_id': 1, 'rec_product_id': 45, 'weight': .5},
+                             {'id': 2, 'product_id': 23, 'rec_type_id': 1, 'rec_product_id': 45, 'weight': .7},
+                             {'id': 3, 'product_id': 23, 'rec_type_id': 2, 'rec_product_id': 45, 'weight': .5}])
+
+    def test_upgrade_schema(self):
+        """ Duplicates are removed and the constraint and index added, once """
+        upgrade_schema(self.engine)
+        upgrade_schema(self.engine)
+        rows = self.engine.execute('SELECT id, weight FROM recommendation ORDER BY id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(2, .7), (3, .5)])
+        indexes = set(index['name'] for index in inspect(self.engine).get_indexes('recommendation'))
+        self.assertEqual(indexes, set(['uq_recommendation_product_type_rec_product',
+                                       'ix_recommendation_product_type_weight']))
+        self.assertRaises(IntegrityError, self.engine.execute, Recommendation.__table__.insert(),
+                          {'product_id': 23, 'rec_type_id': 2, 'rec_product_id': 45, 'weight': .9})
+
 ######################################################################
 #   M A I N
 ######################################################################
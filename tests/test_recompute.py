@@ -0,0 +1,186 @@
+""" Test cases for the Full Catalog Recompute Job """
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from app.catalog import CatalogIndex
+from app.engine import Engine, ParsedProduct
+from app.models import Recommendation
+from app.recompute import applyProductDelta, computeProductDelta, loadCatalog, readCheckpoint, recompute, writeChunk
+from harness import TransactionalTestCase
+
+PRODUCTS = [
+    {"id": 1, "name": "socks", "category": "footwear", "price": "4.50"},
+    {"id": 2, "name": "shoes", "category": "footwear", "price": "8.50"},
+    {"id": 3, "name": "flipflops", "category": "swimwear", "price": "8.50"},
+    {"id": 4, "name": "broccoli", "category": "vegetables", "price": ".50"}
+]
+
+class RecomputeTestCase(unittest.TestCase):
+    """ Recompute Job Tests """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.ndjson = os.path.join(self.folder, 'catalog.ndjson')
+        with open(self.ndjson, 'w') as catalog:
+            catalog.write('\n'.join(json.dumps(product) for product in PRODUCTS) + '\n\n')
+        self.array = os.path.join(self.folder, 'catalog.json')
+        with open(self.array, 'w') as catalog:
+            json.dump(PRODUCTS, catalog)
+        self.checkpoint = os.path.join(self.folder, 'catalog.checkpoint')
+        self.written = []
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def writer(self, anchor_ids, rec_type_ids, rows):
+        self.written.append((anchor_ids, rec_type_ids, rows))
+
+    def test_load_catalog(self):
+        """ Load NDJSON and JSON array catalogs """
+        self.assertEqual(len(loadCatalog(self.ndjson)), 4)
+        self.assertEqual([json.loads(p) for p in loadCatalog(self.array)],
+                         [json.loads(p) for p in loadCatalog(self.ndjson)])
+
+    def test_load_catalog_duplicates(self):
+        """ A repeated product id keeps its last record """
+        with open(self.ndjson, 'a') as catalog:
+            catalog.write(json.dumps(dict(PRODUCTS[0], price="9.50")) + '\n')
+        products = [json.loads(p) for p in loadCatalog(self.ndjson)]
+        self.assertEqual([p['id'] for p in products], [1, 2, 3, 4])
+        self.assertEqual(products[0]['price'], "9.50")
+
+    def test_load_catalog_skips_invalid_products(self):
+        """ Products without a numeric id, a category or a price are skipped """
+        with open(self.ndjson, 'a') as catalog:
+            catalog.write('{"id": 5, "category": "footwear"}\n')
+            catalog.write('{"id": "five", "category": "footwear", "price": "1.00"}\n')
+            catalog.write('{"category": "footwear", "price": "1.00"}\n')
+            catalog.write('not json\n')
+        products = [json.loads(p) for p in loadCatalog(self.ndjson)]
+        self.assertEqual([p['id'] for p in products], [1, 2, 3, 4])
+        stats = recompute(self.ndjson, [(1, 'up-sell')], processes=1, writer=self.writer)
+        self.assertEqual(stats['anchors'], 4)
+
+    def test_recompute(self):
+        """ Recompute every anchor of a catalog """
+        stats = recompute(self.ndjson, [(1, 'up-sell')], self.checkpoint,
+                          processes=2, chunk_size=3, writer=self.writer)
+        self.assertEqual(stats['anchors'], 4)
+        self.assertEqual(stats['pairs'], 12)
+        rows = sorted((row['product_id'], row['rec_product_id'], row['weight'])
+                      for chunk in self.written for row in chunk[2])
+        self.assertEqual(rows, [(1, 2, 2.0), (1, 3, 1.0), (2, 1, 1.0),
+                                (4, 1, 1.0), (4, 2, 1.0), (4, 3, 1.0)])
+        self.assertEqual(stats['rows'], len(rows))
+        self.assertTrue(stats['pairs_per_second'] > 0)
+        self.assertEqual(readCheckpoint(self.checkpoint), set([1, 2, 3, 4]))
+
+    def test_resume(self):
+        """ Resume skips the anchors in the checkpoint """
+        with open(self.checkpoint, 'w') as checkpoint:
+            checkpoint.write('1\n3\n')
+        stats = recompute(self.array, [(1, 'up-sell')], self.checkpoint,
+                          processes=1, writer=self.writer)
+        self.assertEqual(stats['anchors'], 2)
+        self.assertEqual(self.written[0][0], [2, 4])
+        self.assertEqual(self.written[0][1], [1])
+        self.assertEqual(readCheckpoint(self.checkpoint), set([1, 2, 3, 4]))
+
+    def test_product_delta(self):
+        """ A price change only affects its category and the flipped price range """
+        index = CatalogIndex(loadCatalog(self.ndjson))
+        index.add(ParsedProduct(5, "toys", 20.0))
+        weights = computeProductDelta(index, ParsedProduct(1, "footwear", 9.0), [(1, 'up-sell')])
+        self.assertEqual(sorted(set(key[2] for key in weights if key[0] == 1)), [2, 3])
+        self.assertEqual(weights[(1, 1, 2)], 1)
+        self.assertEqual(weights[(2, 1, 1)], 2)
+        self.assertEqual(weights[(1, 1, 3)], 0)
+        self.assertEqual(weights[(3, 1, 1)], 1)
+        self.assertEqual(index.get(1).price, 9.0)
+
+    def test_product_delta_matches_engine(self):
+        """ Every affected weight matches the Engine """
+        index = CatalogIndex(loadCatalog(self.ndjson))
+        changed = '{"id": 2, "category": "swimwear", "price": "3"}'
+        weights = computeProductDelta(index, changed, [(1, 'up-sell')])
+        self.assertEqual(len(weights), 4)
+        for (product_id, rec_type_id, rec_product_id), weight in weights.items():
+            product = index.get(product_id)
+            other = index.get(rec_product_id)
+            metadata = '{"id": %d, "category": "%s", "price": %r}'
+            engine = Engine(metadata % (product.id, product.category, product.price), rec_type_id)
+            self.assertEqual(weight, engine.getWeight(metadata % (other.id, other.category, other.price)))
+
+    def test_product_delta_new_product(self):
+        """ A new product is compared against the whole catalog """
+        index = CatalogIndex(loadCatalog(self.ndjson))
+        weights = computeProductDelta(index, ParsedProduct(9, "toys", 1.0), [(1, 'up-sell')])
+        self.assertEqual(len(weights), 8)
+        self.assertTrue(9 in index)
+
+    def test_product_delta_unsupported_type(self):
+        """ Incremental updates need rule based types """
+        index = CatalogIndex(loadCatalog(self.ndjson))
+        self.assertRaises(ValueError, computeProductDelta, index, ParsedProduct(1, "footwear", 9.0), [(3, 'cross-sell')])
+
+
+class RecomputeDatabaseTestCase(TransactionalTestCase):
+    """ Recompute Job Tests that write to the database """
+
+    def setUp(self):
+        TransactionalTestCase.setUp(self)
+        self.folder = tempfile.mkdtemp()
+        self.ndjson = os.path.join(self.folder, 'catalog.ndjson')
+        with open(self.ndjson, 'w') as catalog:
+            # product 2 is listed twice, the later record wins
+            for product in PRODUCTS + [dict(PRODUCTS[1], price="3.00")]:
+                catalog.write(json.dumps(product) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        TransactionalTestCase.tearDown(self)
+
+    def rows(self):
+        return sorted((rec.product_id, rec.rec_type_id, rec.rec_product_id, rec.weight)
+                      for rec in Recommendation.all())
+
+    def test_write_chunks(self):
+        """ Recompute replaces the rows of every anchor, once per product """
+        Recommendation(product_id=1, rec_type_id=1, rec_product_id=99, weight=5).save()
+        Recommendation(product_id=1, rec_type_id=2, rec_product_id=99, weight=5).save()
+        stats = recompute(self.ndjson, [(1, 'up-sell')], None, processes=1, chunk_size=2, writer=writeChunk)
+        self.assertEqual(stats['anchors'], 4)
+        self.assertEqual(self.rows(), [(1, 1, 2, 1.0), (1, 1, 3, 1.0), (1, 2, 99, 5.0),
+                                       (2, 1, 1, 2.0), (2, 1, 3, 1.0),
+                                       (4, 1, 1, 1.0), (4, 1, 2, 1.0), (4, 1, 3, 1.0)])
+
+    def test_apply_product_delta(self):
+        """ A price change inserts, updates and deletes only the affected rows """
+        for product_id, rec_product_id, weight in [(1, 2, 2), (1, 3, 1), (2, 1, 1), (4, 1, 1), (4, 2, 1), (4, 3, 1)]:
+            Recommendation(product_id=product_id, rec_type_id=1, rec_product_id=rec_product_id, weight=weight).save()
+        index = CatalogIndex(json.dumps(product) for product in PRODUCTS)
+
+        touched = applyProductDelta(index, ParsedProduct(1, "footwear", 9.0), [(1, 'up-sell')])
+        self.assertEqual(touched, 4)
+        self.assertEqual(self.rows(), [(1, 1, 2, 1.0), (2, 1, 1, 2.0), (3, 1, 1, 1.0),
+                                       (4, 1, 1, 1.0), (4, 1, 2, 1.0), (4, 1, 3, 1.0)])
+        self.assertEqual(index.get(1).price, 9.0)
+        self.assertEqual(applyProductDelta(index, ParsedProduct(1, "footwear", 9.0), [(1, 'up-sell')]), 0)
+
+    def test_failed_product_delta_keeps_index(self):
+        """ The index is put back when the rows cannot be written """
+        index = CatalogIndex(json.dumps(product) for product in PRODUCTS)
+        with patch('app.recompute._writeProductDelta', side_effect=RuntimeError('database is gone')):
+            self.assertRaises(RuntimeError, applyProductDelta, index,
+                              ParsedProduct(1, "footwear", 9.0), [(1, 'up-sell')])
+            self.assertRaises(RuntimeError, applyProductDelta, index,
+                              ParsedProduct(9, "toys", 1.0), [(1, 'up-sell')])
+        self.assertEqual(index.get(1).price, 4.5)
+        self.assertFalse(9 in index)
+        self.assertEqual(self.rows(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# Test cases can be run with:
+# nosetests
+# coverage report -m
+
+""" Test cases for routing reads to the read replicas """
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from app import app, server
+from app.models import db, Recommendation, RecommendationType
+from app.cache import response_cache
+from flask_api import status    # HTTP Status Codes
+
+# The primary and every replica hold one recommendation of product 1 with
+# their own id and recommended product, so the answer shows who served it
+DATABASES = [(None, 1, 10), ('replica_1', 2, 11), ('replica_2', 3, 12)]
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicaRouting(unittest.TestCase):
+    """ A primary and two replicas, each a SQLite file """
+
+    def setUp(self):
+        self.saved = dict((key, app.config.get(key)) for key in
+                          ('SQLALCHEMY_DATABASE_URI', 'SQLALCHEMY_BINDS', 'SQLALCHEMY_REPLICAS',
+                           'RESPONSE_CACHE_ENABLED', 'RESPONSE_CACHE_BACKEND'))
+        self.directory = tempfile.mkdtemp()
+        uri = lambda name: 'sqlite:///' + os.path.join(self.directory, name + '.db')
+        app.config['SQLALCHEMY_DATABASE_URI'] = uri('primary')
+        app.config['SQLALCHEMY_BINDS'] = {'replica_1': uri('replica_1'), 'replica_2': uri('replica_2')}
+        app.config['SQLALCHEMY_REPLICAS'] = ['replica_1', 'replica_2']
+        db.session.remove()
+
+        for bind, rec_id, rec_product_id in DATABASES:
+            engine = db.get_engine(app, bind=bind)
+            db.Model.metadata.create_all(bind=engine)
+            engine.execute(RecommendationType.__table__.insert(),
+                           {'id': 1, 'name': 'up-sell', 'is_active': True, 'product_query': 'category=values'})
+            engine.execute(Recommendation.__table__.insert(),
+                           {'id': rec_id, 'product_id': 1, 'rec_type_id': 1,
+                            'rec_product_id': rec_product_id, 'weight': .5})
+
+    def tearDown(self):
+        db.session.remove()
+        app.config.update(self.saved)
+        shutil.rmtree(self.directory)
+
+    def read_product(self):
+        """ Returns the recommended products of product 1 in a new session """
+        db.session.remove()
+        return [rec.rec_product_id for rec in Recommendation.find_by_product_id(1)]
+
+    def count_on(self, bind):
+        """ Number of recommendations stored in one database """
+        return db.get_engine(app, bind=bind).execute('SELECT COUNT(*) FROM recommendation').scalar()
+
+    def test_finders_read_from_replicas_round_robin(self):
+        """ The finders alternate between the replicas """
+        served = [self.read_product() for _ in range(4)]
+        self.assertEqual(sorted(served), [[11], [11], [12], [12]])
+        self.assertNotEqual(served[0], served[1])
+
+    def test_reads_use_primary_without_replicas(self):
+        """ Without replicas the finders read from the primary """
+        app.config['SQLALCHEMY_REPLICAS'] = []
+        self.assertEqual(self.read_product(), [10])
+
+    def test_writes_go_to_primary(self):
+        """ Saves are written to the primary only """
+        Recommendation(product_id=2, rec_type_id=1, rec_product_id=20, weight=.5).save()
+        self.assertEqual(self.count_on(None), 2)
+        self.assertEqual(self.count_on('replica_1'), 1)
+        self.assertEqual(self.count_on('replica_2'), 1)
+
+    def test_session_reads_its_own_writes(self):
+        """ After a write the session reads from the primary """
+        db.session.remove()
+        db.session.add(Recommendation(product_id=1, rec_type_id=1, rec_product_id=13, weight=.1))
+        db.session.flush()
+        recs = Recommendation.find_by_product_id(1)
+        self.assertEqual([rec.rec_product_id for rec in recs], [10, 13])
+        db.session.rollback()
+
+    def test_write_request_reads_from_primary(self):
+        """ A request that changes data finds the rows on the primary """
+        client = server.app.test_client()
+        resp = client.get('/recommendations/1')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = client.delete('/recommendations/1')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.count_on(None), 0)
+
+    def test_tagged_reads_use_primary(self):
+        """ Lists that get an ETag or are cached are read from the primary, the version may be newer than a replica """
+        client = server.app.test_client()
+        app.config['RESPONSE_CACHE_ENABLED'] = False
+        app.config['RESPONSE_CACHE_BACKEND'] = None
+        resp = client.get('/recommendations?product_id=1')
+        self.assertNotIn('ETag', resp.headers)
+        self.assertIn([rec['rec_product_id'] for rec in json.loads(resp.data)], [[11], [12]])
+
+        app.config['RESPONSE_CACHE_BACKEND'] = 'memory://'
+        for path in ('/recommendations?product_id=1', '/products/1/recommendations'):
+            resp = client.get(path)
+            self.assertIn('ETag', resp.headers)
+            self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [10])
+
+        app.config['RESPONSE_CACHE_ENABLED'] = True
+        app.config['RESPONSE_CACHE_BACKEND'] = None
+        response_cache.clear()
+        resp = client.get('/products/1/recommendations')
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [10])
+        response_cache.clear()
+
+    def test_initialize_db_reads_from_primary(self):
+        """ Initializing against lagging replicas neither reseeds the primary nor loses the types """
+        for bind in ('replica_1', 'replica_2'):
+            db.get_engine(app, bind=bind).execute('DELETE FROM recommendation_type')
+        db.session.remove()
+        server.initialize_db()
+        types = db.get_engine(app).execute('SELECT name FROM recommendation_type').fetchall()
+        self.assertEqual([name for (name,) in types], ['up-sell'])
+        self.assertIn(1, server.scorer_registry)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -10,10 +10,13 @@ import mock
 import os
 import unittest
 from app import server
+from app.cache import response_cache, ResponseCache
 from app.models import db, init_db
 from app.models import Recommendation, RecommendationType
 from flask_api import status    # HTTP Status Codes
 from mock import patch
+from sqlalchemy import event
+from harness import TransactionalTestCase
 
 APP_SETTING = os.getenv('APP_SETTING', 'TestingConfig')
 
@@ -31,13 +34,12 @@ HTTP_500_INTERNAL_SERVER_ERROR = 500
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
-class TestRecommendationServer(unittest.TestCase):
+class TestRecommendationServer(TransactionalTestCase):
     """ Recommendation Server Tests """
 
     def setUp(self):
         """ Runs before each test """
-        
-        server.app.config.from_object('config.%s' % str(APP_SETTING))
+        TransactionalTestCase.setUp(self)
         self.app = server.app.test_client()
         server.initialize_logging()
         server.initialize_db()
@@ -62,11 +64,6 @@ class TestRecommendationServer(unittest.TestCase):
         rec.deserialize(data)
         rec.save()
 
-    def tearDown(self):
-        """ Runs after each test """
-        db.session.close()
-        db.drop_all()
-
     def test_index_view(self):
         """ Test the Home Page """
         resp = self.app.get('/index')
@@ -99,6 +96,257 @@ class TestRecommendationServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(len(json.loads(resp.data)), 2)
 
+    def test_get_recommendation_list_pages(self):
+        """ Page through Recommendations with limit and cursor """
+        resp = self.app.get('/recommendations?limit=3')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        first = json.loads(resp.data)
+        self.assertEqual([rec['id'] for rec in first], [1, 2, 3])
+        link = resp.headers.get('Link')
+        self.assertIn('rel="next"', link)
+
+        resp = self.app.get(link[link.index('/recommendations'):link.index('>')])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec['id'] for rec in json.loads(resp.data)], [4])
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_get_product_recommendations_by_weight(self):
+        """ Page through a product's Recommendations by weight """
+        for i, weight in enumerate([.2, .9, .9, .4]):
+            rec = Recommendation()
+            rec.deserialize({"product_id": 77, "rec_type_id": 1, "rec_product_id": i, "weight": weight})
+            rec.save()
+
+        resp = self.app.get('/recommendations?product_id=77&limit=2')
+        data = json.loads(resp.data)
+        self.assertEqual([(rec['rec_product_id'], rec['weight']) for rec in data], [(1, .9), (2, .9)])
+        link = resp.headers.get('Link')
+        resp = self.app.get(link[link.index('/recommendations'):link.index('>')])
+        data = json.loads(resp.data)
+        self.assertEqual([(rec['rec_product_id'], rec['weight']) for rec in data], [(3, .4), (0, .2)])
+
+    def test_get_recommendation_list_bad_page(self):
+        """ Reject a bad limit or cursor """
+        resp = self.app.get('/recommendations?limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/recommendations?limit=ten')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/recommendations?cursor=not-a-cursor')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_recommendation_list(self):
+        """ Stream all Recommendations as a JSON array """
+        resp = self.app.get('/recommendations?stream=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertTrue(resp.is_streamed)
+        data = json.loads(resp.data)
+        self.assertEqual([rec['id'] for rec in data], [1, 2, 3, 4])
+        self.assertEqual(data[0]['rec_type']['name'], 'up-sell')
+
+    def test_stream_recommendation_list_ndjson(self):
+        """ Stream Recommendations as NDJSON """
+        resp = self.app.get('/recommendations?type=up-sell', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.splitlines()
+        self.assertEqual([json.loads(line)['product_id'] for line in lines], [23, 33])
+
+    def test_list_query_count_is_constant(self):
+        """ Listing Recommendations does not issue a query per row """
+        for offset, path in [(100, '/recommendations'), (200, '/recommendations?type=up-sell')]:
+            before = self.count_queries(path)
+            for i in range(10):
+                rec = Recommendation()
+                rec.deserialize({"product_id": offset + i, "rec_type_id": 1, "rec_product_id": i, "weight": .1})
+                rec.save()
+            db.session.remove()
+            self.assertEqual(self.count_queries(path), before)
+
+    def test_cached_recommendation_list(self):
+        """ A repeated list query is served from the response cache """
+        self.enable_response_cache()
+        path = '/recommendations?product_id=23&type=up-sell'
+        first = self.app.get(path)
+        self.assertEqual(self.count_queries(path), 0)
+        self.assertEqual(self.app.get(path.replace('up-sell', 'UP-SELL')).data, first.data)
+        info = json.loads(self.app.get('/recommendations/cache').data)
+        self.assertEqual((info['hits'], info['misses'], info['size']), (2, 1, 1))
+        self.assertTrue(info['enabled'])
+
+    def test_write_invalidates_cached_list(self):
+        """ Writes evict the cached pages of their product and type only """
+        self.enable_response_cache()
+        self.app.get('/recommendations?product_id=23&type=up-sell')
+        self.app.get('/recommendations?product_id=51')
+
+        data = json.dumps({"product_id": 23, "rec_type_id": 1, "rec_product_id": 46, "weight": 0.9})
+        resp = self.app.post('/recommendations', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        resp = self.app.get('/recommendations?product_id=23&type=up-sell')
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [46, 45])
+        self.assertEqual(self.count_queries('/recommendations?product_id=51'), 0)
+
+        resp = self.app.put('/recommendations/deactivate/1', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/recommendations?product_id=23&type=up-sell')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_write_on_other_instance_invalidates_cached_list(self):
+        """ A write on another instance evicts the pages this one cached """
+        self.enable_response_cache()
+        self.share_response_cache()
+        path = '/recommendations?product_id=23&type=up-sell'
+        etag = self.app.get(path).headers['ETag']
+        self.assertEqual(self.count_queries(path), 0)
+
+        other = ResponseCache()
+        other.attach(response_cache.backend)
+        other.invalidate(23, 1)
+        self.assertNotEqual(self.count_queries(path), 0)
+        self.assertNotEqual(self.app.get(path).headers['ETag'], etag)
+        other.detach()
+
+    @patch('app.cache.create_backend')
+    def test_unreachable_shared_cache(self, create_backend):
+        """ Reads and writes work on the local cache while the shared backend is down """
+        create_backend.return_value.subscribe.side_effect = IOError('Connection refused')
+        self.enable_response_cache()
+        self.share_response_cache()
+        resp = self.app.get('/recommendations?product_id=23')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.dumps({"product_id": 23, "rec_type_id": 1, "rec_product_id": 46, "weight": 0.9})
+        resp = self.app.post('/recommendations', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(json.loads(self.app.get('/recommendations?product_id=23').data)), 2)
+        # retried after the backoff, not on every request
+        self.assertEqual(create_backend.call_count, 1)
+        self.assertIsNone(response_cache.backend)
+
+    def test_list_not_modified(self):
+        """ A list whose ETag is current is answered with 304 without reading it """
+        self.share_response_cache()
+        path = '/recommendations?product_id=23&type=up-sell'
+        etag = self.app.get(path).headers['ETag']
+        headers = {'If-None-Match': etag}
+        # only the type is looked up
+        self.assertEqual(self.count_queries(path, headers, status.HTTP_304_NOT_MODIFIED), 1)
+        resp = self.app.get(path, headers=headers)
+        self.assertEqual((resp.data, resp.headers['ETag']), ('', etag))
+
+        data = json.dumps({"product_id": 51, "rec_type_id": 1, "rec_product_id": 46, "weight": 0.9})
+        self.app.post('/recommendations', data=data, content_type='application/json')
+        self.assertEqual(self.app.get(path, headers=headers).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        data = json.dumps({"product_id": 23, "rec_type_id": 1, "rec_product_id": 46, "weight": 0.9})
+        self.app.post('/recommendations', data=data, content_type='application/json')
+        resp = self.app.get(path, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_list_without_shared_cache_has_no_etag(self):
+        """ Without a shared backend a list has no ETag, writes of other processes could not change it """
+        resp = self.app.get('/recommendations?product_id=23')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_cached_list_not_modified(self):
+        """ A cached page is answered with 304 without any query """
+        self.share_response_cache()
+        self.enable_response_cache()
+        path = '/recommendations?product_id=23'
+        etag = self.app.get(path).headers['ETag']
+        self.assertEqual(self.count_queries(path, {'If-None-Match': etag}, status.HTTP_304_NOT_MODIFIED), 0)
+        self.assertEqual(self.app.get(path).headers['ETag'], etag)
+
+    def test_top_recommendations_of_product(self):
+        """ The best Recommendations of a product come highest weight first """
+        self.share_response_cache()
+        for rec_type_id, rec_product_id, weight in [(1, 46, .9), (1, 47, .1), (2, 48, .7)]:
+            data = json.dumps({"product_id": 23, "rec_type_id": rec_type_id,
+                               "rec_product_id": rec_product_id, "weight": weight})
+            self.app.post('/recommendations', data=data, content_type='application/json')
+
+        resp = self.app.get('/products/23/recommendations?limit=3')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [46, 48, 45])
+
+        resp = self.app.get('/products/23/recommendations?type=up-sell&min_weight=0.5')
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [46, 45])
+
+        resp = self.app.get('/products/23/recommendations?limit=1', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/products/23/recommendations?limit=1', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(json.loads(self.app.get('/products/99/recommendations').data), [])
+
+    def test_top_recommendations_bad_request(self):
+        """ Bad limits, weights and types are refused """
+        for path, code in [('/products/23/recommendations?limit=0', status.HTTP_400_BAD_REQUEST),
+                           ('/products/23/recommendations?min_weight=heavy', status.HTTP_400_BAD_REQUEST),
+                           ('/products/23/recommendations?type=foo', status.HTTP_404_NOT_FOUND)]:
+            self.assertEqual(self.app.get(path).status_code, code)
+
+    def test_cached_top_recommendations(self):
+        """ The best Recommendations are served from the response cache until a write """
+        self.share_response_cache()
+        self.enable_response_cache()
+        path = '/products/23/recommendations?type=up-sell'
+        first = self.app.get(path)
+        self.assertEqual(self.count_queries(path), 0)
+        data = json.dumps({"product_id": 23, "rec_type_id": 1, "rec_product_id": 46, "weight": 0.9})
+        self.app.post('/recommendations', data=data, content_type='application/json')
+        resp = self.app.get(path)
+        self.assertNotEqual(resp.headers['ETag'], first.headers['ETag'])
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [46, 45])
+
+    def test_lookup_recommendations(self):
+        """ The Recommendations of many products are returned grouped by product """
+        for rec_product_id, weight in [(46, .9), (47, .1)]:
+            data = json.dumps({"product_id": 23, "rec_type_id": 1, "rec_product_id": rec_product_id, "weight": weight})
+            self.app.post('/recommendations', data=data, content_type='application/json')
+
+        lookup = {'product_ids': [51, 23, 7], 'limit': 2}
+        self.assertEqual(self.count_queries('/recommendations/lookup', data=lookup), 1)
+        resp = self.app.post('/recommendations/lookup', data=json.dumps(lookup), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([result['product_id'] for result in data], [51, 23, 7])
+        self.assertEqual([rec['rec_product_id'] for rec in data[1]['recommendations']], [46, 45])
+        self.assertEqual(data[2]['recommendations'], [])
+
+        lookup = {'product_ids': [23, 51], 'type': 'accessory'}
+        resp = self.app.post('/recommendations/lookup', data=json.dumps(lookup), content_type='application/json')
+        self.assertEqual([len(result['recommendations']) for result in json.loads(resp.data)], [0, 1])
+
+    def test_lookup_recommendations_without_limit(self):
+        """ Without a limit a lookup returns every Recommendation of each product """
+        server.app.config['RECOMMENDATION_PAGE_SIZE'] = 1
+        server.app.config['RECOMMENDATION_MAX_PAGE_SIZE'] = 2
+        for rec_product_id, weight in [(46, .9), (47, .1)]:
+            data = json.dumps({"product_id": 23, "rec_type_id": 1, "rec_product_id": rec_product_id, "weight": weight})
+            self.app.post('/recommendations', data=data, content_type='application/json')
+
+        resp = self.app.post('/recommendations/lookup', data=json.dumps({'product_ids': [23]}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)[0]['recommendations']], [46, 45, 47])
+
+        resp = self.app.post('/recommendations/lookup', data=json.dumps({'product_ids': [23], 'limit': 5}),
+                             content_type='application/json')
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)[0]['recommendations']], [46, 45])
+
+    def test_lookup_recommendations_bad_request(self):
+        """ A lookup of no, too many or unknown kinds of products is refused """
+        server.app.config['RECOMMENDATION_MAX_LOOKUP_PRODUCTS'] = 2
+        for lookup, code in [({'product_ids': []}, status.HTTP_400_BAD_REQUEST),
+                             ({'product_ids': [1, 2, 3]}, status.HTTP_400_BAD_REQUEST),
+                             ({'product_ids': [1], 'type': 'foo'}, status.HTTP_404_NOT_FOUND)]:
+            resp = self.app.post('/recommendations/lookup', data=json.dumps(lookup), content_type='application/json')
+            self.assertEqual(resp.status_code, code)
+
     def test_query_recommendation_list_by_product(self):
         """ Query Recommendation By Product Id """
         resp = self.app.get('/recommendations?product_id=23')
@@ -113,6 +361,28 @@ class TestRecommendationServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(len(json.loads(resp.data)), 1)
 
+    def test_get_recommendation_not_modified(self):
+        """ A Recommendation whose ETag is current is answered with 304 """
+        etag = self.app.get('/recommendations/2').headers['ETag']
+        headers = {'If-None-Match': etag}
+        self.assertEqual(self.app.get('/recommendations/2', headers=headers).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        # writes of other Recommendations keep the ETag, a write of this one changes it
+        data = json.dumps({"product_id": 51, "rec_type_id": 2, "rec_product_id": 46, "weight": 0.9})
+        self.app.post('/recommendations', data=data, content_type='application/json')
+        self.assertEqual(self.app.get('/recommendations/2', headers=headers).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        data = json.dumps({"product_id": 51, "rec_type_id": 2, "rec_product_id": 50, "weight": 0.7})
+        self.app.put('/recommendations/2', data=data, content_type='application/json')
+        resp = self.app.get('/recommendations/2', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        resp = self.app.delete('/recommendations/2')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get('/recommendations/2', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_get_recommendation(self):
         """ Get one Recommendation """
         resp = self.app.get('/recommendations/2')
@@ -185,12 +455,6 @@ class TestRecommendationServer(unittest.TestCase):
     def test_create_recommendation(self):
         """ Create a Recommendation """
         # save the current number of recommendations for later comparison
-        
-        data = { "product_id": 33, "rec_type_id": 1, "rec_product_id": 41, "weight": 3.5 }
-        rec = Recommendation()
-        rec.deserialize(data)
-        rec.save()
-
         recommendation_count = self.get_recommendation_count()
 
         # add a new recommendation
@@ -220,6 +484,150 @@ class TestRecommendationServer(unittest.TestCase):
         self.assertEqual(len(data), recommendation_count + 1)
         self.assertIn(new_json, data)
 
+    def test_create_duplicate_recommendation(self):
+        """ Create a Recommendation that already exists """
+        recommendation_count = self.get_recommendation_count()
+        data = json.dumps({"product_id": 33, "rec_type_id": 1, "rec_product_id": 41, "weight": 1.0})
+        resp = self.app.post('/recommendations', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.get_recommendation_count(), recommendation_count)
+
+    def test_create_recommendation_unknown_type(self):
+        """ A Recommendation of a type that does not exist is refused, not reported as a conflict """
+        data = json.dumps({"product_id": 23, "rec_type_id": 9, "rec_product_id": 46, "weight": 0.5})
+        resp = self.app.post('/recommendations', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put('/recommendations/2', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_recommendation_count(), 4)
+
+    def test_manage_view_create_recommendation(self):
+        """ The manage view creates a Recommendation and refuses duplicates and unknown types """
+        data = json.dumps({"product_id": 23, "rec_type_id": 1, "rec_product_id": 46, "weight": 0.5})
+        resp = self.app.get('/recommendations/manage/1', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get('/recommendations/manage/1', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        data = json.dumps({"product_id": 23, "rec_type_id": 9, "rec_product_id": 47, "weight": 0.5})
+        resp = self.app.get('/recommendations/manage/1', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_recommendation_count(), 5)
+
+    def test_bulk_create_recommendations(self):
+        """ Create Recommendations in bulk from a JSON array """
+        recommendation_count = self.get_recommendation_count()
+        items = [{"product_id": 60 + i, "rec_type_id": 1, "rec_product_id": 70 + i, "weight": 0.1 * i}
+                 for i in range(5)]
+        resp = self.app.post('/recommendations/bulk', data=json.dumps(items), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = json.loads(resp.data)
+        self.assertEqual(data['created'], 5)
+        self.assertEqual(data['errors'], [])
+        self.assertEqual(self.get_recommendation_count(), recommendation_count + 5)
+
+    def test_bulk_create_recommendations_partial(self):
+        """ Create Recommendations in bulk reporting the invalid items """
+        recommendation_count = self.get_recommendation_count()
+        items = [{"product_id": 60, "rec_type_id": 1, "rec_product_id": 70, "weight": 0.5},
+                 {"product_id": 61},
+                 {"product_id": 62, "rec_type_id": 9, "rec_product_id": 72, "weight": 0.5},
+                 {"product_id": 23, "rec_type_id": 1, "rec_product_id": 45, "weight": 0.5}]
+        resp = self.app.post('/recommendations/bulk', data=json.dumps(items), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([error['index'] for error in data['errors']], [1, 2, 3])
+        self.assertEqual(self.get_recommendation_count(), recommendation_count + 1)
+
+    def test_bulk_create_recommendations_out_of_range(self):
+        """ Create Recommendations in bulk refusing ids too large for the database """
+        recommendation_count = self.get_recommendation_count()
+        items = [{"product_id": 2 ** 31, "rec_type_id": 1, "rec_product_id": 70, "weight": 0.5},
+                 {"product_id": 61, "rec_type_id": 1, "rec_product_id": 71, "weight": 0.5}]
+        resp = self.app.post('/recommendations/bulk', data=json.dumps(items), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([error['index'] for error in data['errors']], [0])
+        self.assertEqual(self.get_recommendation_count(), recommendation_count + 1)
+
+    def test_bulk_create_recommendations_atomic(self):
+        """ Create Recommendations in bulk all or nothing """
+        recommendation_count = self.get_recommendation_count()
+        items = [{"product_id": 60, "rec_type_id": 1, "rec_product_id": 70, "weight": 0.5},
+                 {"product_id": 61}]
+        resp = self.app.post('/recommendations/bulk', query_string='atomic=true',
+                             data=json.dumps(items), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(resp.data)['created'], 0)
+        self.assertEqual(self.get_recommendation_count(), recommendation_count)
+
+    def test_bulk_create_recommendations_ndjson(self):
+        """ Create Recommendations in bulk from NDJSON """
+        lines = [json.dumps({"product_id": 60 + i, "rec_type_id": 2, "rec_product_id": 70, "weight": 0.5})
+                 for i in range(3)]
+        resp = self.app.post('/recommendations/bulk', data='\n'.join(lines) + '\n',
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(resp.data)['created'], 3)
+
+    def test_bulk_create_recommendations_bad_body(self):
+        """ Create Recommendations in bulk without a list """
+        resp = self.app.post('/recommendations/bulk', data='{}', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_replace_recommendation_set(self):
+        """ Replace the Recommendations of a Product """
+        existing_id = json.loads(self.app.get('/recommendations', query_string='product_id=23').data)[0]['id']
+        items = [{"rec_product_id": 45, "weight": 0.9},
+                 {"rec_product_id": 46, "weight": 0.4}]
+        resp = self.app.put('/recommendations/products/23/1', data=json.dumps(items),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([(rec['rec_product_id'], rec['weight']) for rec in data], [(45, 0.9), (46, 0.4)])
+        self.assertEqual(data[0]['id'], existing_id)
+
+        # the existing row was updated in place and the others are untouched
+        resp = self.app.get('/recommendations', query_string='product_id=23')
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [45, 46])
+        self.assertEqual(self.get_recommendation_count(), 5)
+
+        # products left out of the set are removed
+        resp = self.app.put('/recommendations/products/23/1', data=json.dumps([{"rec_product_id": 46, "weight": 1.0}]),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([rec['rec_product_id'] for rec in json.loads(resp.data)], [46])
+
+        resp = self.app.put('/recommendations/products/23/1', data='[]', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [])
+        self.assertEqual(self.get_recommendation_count(), 3)
+
+    def test_replace_recommendation_set_bad_data(self):
+        """ Replace the Recommendations of a Product with an invalid set """
+        items = [{"rec_product_id": 46, "weight": 0.9},
+                 {"rec_product_id": 46, "weight": 0.4}]
+        resp = self.app.put('/recommendations/products/23/1', data=json.dumps(items),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put('/recommendations/products/23/1', data=json.dumps([{"weight": 0.9}]),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_recommendation_count(), 4)
+
+    def test_replace_recommendation_set_out_of_range(self):
+        """ Replace the Recommendations of a Product whose id is too large for the database """
+        resp = self.app.put('/recommendations/products/%d/1' % 2 ** 31, data='[{"rec_product_id": 46, "weight": 0.9}]',
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_recommendation_count(), 4)
+
+    def test_replace_recommendation_set_unknown_type(self):
+        """ Replace the Recommendations of a Product for a type that does not exist """
+        resp = self.app.put('/recommendations/products/23/9', data='[]', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_update_recommendation(self):
         """ Update a Recommendation """
         rec_changes = {"product_id": 50, \
@@ -280,8 +688,8 @@ class TestRecommendationServer(unittest.TestCase):
 
     def test_get_query_recommendation_when_no_data_exist(self):
         """ Get a Recommendation thats not found """
-        db.drop_all()
-        db.create_all()
+        Recommendation.remove_all()
+        RecommendationType.remove_all()
         resp = self.app.get('/recommendations', query_string='type=up-sell')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
@@ -322,6 +730,34 @@ class TestRecommendationServer(unittest.TestCase):
         data = json.loads(resp.data)
         return len(data)
 
+    def enable_response_cache(self):
+        """ Turns the response cache on for one test, the next setUp turns it off again """
+        server.app.config['RESPONSE_CACHE_ENABLED'] = True
+        response_cache.clear()
+
+    def share_response_cache(self):
+        """ Gives the response cache a new shared backend for one test, the next setUp detaches it """
+        response_cache.detach()
+        server.app.config['RESPONSE_CACHE_BACKEND'] = 'memory://'
+
+    def count_queries(self, path, headers=None, code=status.HTTP_200_OK, data=None):
+        """ Returns the number of SQL statements a GET request, or a POST of JSON data, runs """
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            # the SAVEPOINT that the test harness reopens after a commit is not the request's
+            if not statement.startswith('SAVEPOINT'):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            if data is None:
+                resp = self.app.get(path, headers=headers)
+            else:
+                resp = self.app.post(path, data=json.dumps(data), content_type='application/json')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        self.assertEqual(resp.status_code, code)
+        return len(statements)
+
 
 ######################################################################
 #   M A I N
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from app.similarity import CrossSellIndex, FeatureEncoder, LSHIndex, bruteForce, recall
+
+PRODUCTS = [
+    {"id": 1, "name": "socks", "category": "footwear", "price": "4.50", "color": "white"},
+    {"id": 2, "name": "shoes", "category": "footwear", "price": "80.00", "color": "black"},
+    {"id": 3, "name": "boots", "category": "footwear", "price": "95.00", "color": "black"},
+    {"id": 4, "name": "flipflops", "category": "swimwear", "price": "8.50", "color": "white"},
+    {"id": 5, "name": "broccoli", "category": "vegetables", "price": ".50"}
+]
+
+class SimilarityTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_encoder(self):
+        """Testing Feature Encoding"""
+        encoder = FeatureEncoder(attributes=["color"]).fit(PRODUCTS)
+        self.assertEquals(encoder.dim, 6)
+        vectors = encoder.encodeMany(PRODUCTS)
+        self.assertTrue(np.allclose(np.linalg.norm(vectors, axis=1), 1.0))
+        #broccoli has no color
+        self.assertEquals(vectors[4][4:].tolist(), [0.0, 0.0])
+        rebuilt = FeatureEncoder.fromDict(encoder.toDict())
+        self.assertTrue(np.allclose(rebuilt.encodeMany(PRODUCTS), vectors))
+
+    def test_crossSellIndex(self):
+        """Testing Cross-sell Queries"""
+        index = CrossSellIndex().build(PRODUCTS, attributes=["color"], tables=16, bits=2)
+        results = index.query(PRODUCTS[1], 2, probes=2)
+        self.assertEquals([product_id for product_id, similarity in results], [3, 1])
+        self.assertTrue(results[0][1] > results[1][1])
+
+    def test_saveAndLoad(self):
+        """Testing Saving and Loading an Index"""
+        path = os.path.join(self.folder, "cross-sell.npz")
+        index = CrossSellIndex().build(PRODUCTS, attributes=["color"], tables=4, bits=3)
+        index.save(path)
+        loaded = CrossSellIndex.load(path)
+        self.assertEquals(loaded.query(PRODUCTS[0], 3), index.query(PRODUCTS[0], 3))
+        self.assertEquals(loaded.index.queryById(1, 3), index.index.queryById(1, 3))
+
+    def test_recall(self):
+        """Testing Recall against Brute Force"""
+        vectors = np.random.RandomState(1).randn(2000, 8).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+        ids = np.arange(2000)
+        index = LSHIndex(8, tables=12, bits=6, seed=3).build(ids, vectors)
+        found = []
+        for i in range(20):
+            exact = bruteForce(ids, vectors, vectors[i], 10, exclude=i)
+            self.assertEquals(len(exact), 10)
+            self.assertFalse(i in [product_id for product_id, similarity in exact])
+            found.append(recall(index.queryById(i, 10, probes=1), exact))
+        self.assertTrue(np.mean(found) > 0.8)
+        self.assertEquals(recall([], []), 1.0)
+
+if __name__ == '__main__':
+    unittest.main()